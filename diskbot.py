@@ -109,6 +109,27 @@ def getGeneralInfo(fs):
 
 
 
+def getIOStatsInfo(fs):
+  """Gets the I/O statistics of the filesystem and generates a list of information pairs."""
+  report = fs.ioStats()
+  pairs = []
+  pairs.append( ("I/O STATISTICS", None) )
+  pairs.append( ("Reads", "{0} ({1} bytes)".format(report.reads, report.bytesRead)) )
+  pairs.append( ("Writes", "{0} ({1} bytes)".format(report.writes, report.bytesWritten)) )
+  pairs.append( ("Flushes", "{0}".format(report.flushes)) )
+  pairs.append( ("Discards", "{0}".format(report.discards)) )
+  pairs.append( ("System calls", "{0}".format(report.syscalls)) )
+  for origin in ["superblock", "bgdt", "bitmap", "inodeTable", "directory", "indirect", "data"]:
+    o = report.origins[origin]
+    pairs.append( ("Origin {0}".format(origin), "{0} reads ({1} bytes), {2} writes ({3} bytes), {4} system calls".format(
+      o.reads, o.bytesRead, o.writes, o.bytesWritten, o.syscalls)) )
+  pairs.append( ("Read latency", ["{0} {1}".format(label.ljust(8), count) for label, count in report.readLatency]) )
+  pairs.append( ("Write latency", ["{0} {1}".format(label.ljust(8), count) for label, count in report.writeLatency]) )
+  pairs.append( ("Flush latency", ["{0} {1}".format(label.ljust(8), count) for label, count in report.flushLatency]) )
+  return pairs
+
+
+
 def generateDetailedInfo(fs, showWaitIndicator = True):
   """Scans the filesystem to gather detailed information about space usage and returns
   a list of information pairs."""
@@ -127,6 +148,8 @@ def generateDetailedInfo(fs, showWaitIndicator = True):
     pairs = []
     pairs.append( ("DETAILED STORAGE INFORMATION", None) )
     pairs.append( ("Num regular files", "{0}".format(report.numRegFiles)) )
+    pairs.append( ("Num fragmented files", "{0} ({1} runs of contiguous blocks in all files)".format(
+      report.numFragmentedFiles, report.numFileRuns)) )
     pairs.append( ("Num directories", "{0}".format(report.numDirs)) )
     pairs.append( ("Num symlinks", "{0}".format(report.numSymlinks)) )
     for i,groupReport in enumerate(report.groupReports):
@@ -219,6 +242,12 @@ def printShellHelp():
   print "{0}{1}".format("chgrp gid filename".ljust(sp), "Changes the owner gid of the file to the given gid.")
   print "{0}{1}".format("chmod octmode filename".ljust(sp), "Changes the mode of the file to the one specified.")
   print
+  print "{0}{1}".format("commit".ljust(sp), "Writes the changes held in the delta file to the")
+  print "{0}{1}".format("".ljust(sp), "image file. Only available with the -o option.")
+  print
+  print "{0}{1}".format("resync".ljust(sp), "Rewrites the backup copies of the superblock and")
+  print "{0}{1}".format("".ljust(sp), "block group descriptor table from the primary copies.")
+  print
   print "{0}{1}".format("help".ljust(sp), "Prints this message.")
   print "{0}{1}".format("exit".ljust(sp), "Exits shell mode.")
   print
@@ -346,7 +375,7 @@ def copyFile(fromFile, toDir, newFilename = None, showWaitIndicator = True):
 
   def __copy(wait = None):
     copied = 0
-    for block in fromFile.blocks():
+    for block in fromFile.blocks(1048576):
       newFile.write(block)
       copied += len(block)
       if wait:
@@ -619,6 +648,19 @@ def shell(fs):
           raise ShellError("No filename specified.")
         chFile = getFileObject(fs, workingDir, name, True)
         chFile.permissions = mode
+      
+      
+      elif cmd == "commit":
+        if len(parameters) != 0:
+          raise ShellError("Invalid parameters.")
+        fs.commitDelta()
+        
+      
+      elif cmd == "resync":
+        if len(parameters) != 0:
+          raise ShellError("Invalid parameters.")
+        fs.syncBackups()
+        fs.sync()
         
       
       else:
@@ -680,7 +722,7 @@ def fetchFile(fs, srcFilename, destDirectory, showWaitIndicator = True):
     def __read(wait = None):
       readCount = 0
       with outFile:
-        for block in srcFile.blocks():
+        for block in srcFile.blocks(1048576):
           outFile.write(block)
           readCount += len(block)
           if wait:
@@ -750,7 +792,7 @@ def putFile(fs, srcFilename, destDirectory, showWaitIndicator = True):
         wait.start()
       inFile.seek(0)
       while written < length:
-        byteString = inFile.read(fs.blockSize)
+        byteString = inFile.read(1048576)
         newFile.write(byteString)
         written += len(byteString)
         if wait:
@@ -808,6 +850,13 @@ def printHelp():
   print "{0}{1}".format("-n blockSize numBlocks".ljust(sp), "Creates the specified image file as a new ext2")
   print "{0}{1}".format("".ljust(sp), "image with the specified parameters.")
   print
+  print "{0}{1}".format("-o deltafile".ljust(sp), "Leaves the image file unchanged and writes all")
+  print "{0}{1}".format("".ljust(sp), "changes to the specified delta file instead. The")
+  print "{0}{1}".format("".ljust(sp), "delta file is created if it does not exist.")
+  print
+  print "{0}{1}".format("-t".ljust(sp), "Prints statistics about the I/O issued to the image")
+  print "{0}{1}".format("".ljust(sp), "file after the other options have run.")
+  print
   print "{0}{1}".format("-w".ljust(sp), "Suppress the wait indicator that is typically")
   print "{0}{1}".format("".ljust(sp), "shown for long operations. This is useful when")
   print "{0}{1}".format("".ljust(sp), "redirecting the output of this program.")
@@ -909,9 +958,18 @@ def main():
     
     else:
       try:
-        fs = Ext2Filesystem.fromImageFile(filename)
+        if "-o" in args:
+          i = args.index("-o")
+          if len(args) < i + 2:
+            print "Error! No delta file specified."
+            quit()
+          fs = Ext2Filesystem.fromImageFileWithDelta(filename, args[i+1])
+        else:
+          fs = Ext2Filesystem.fromImageFile(filename)
         with fs:
           run(args, fs)
+        if "-t" in args:
+          printInfoPairs(getIOStatsInfo(fs))
       except IOError:
         print "Could not read image file."
 
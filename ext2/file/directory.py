@@ -22,6 +22,7 @@ def _openRootDirectory(fs):
 
 class _EntryList(object):
   """Represents a doubly-liked directory list in the Ext2 filesystem. For internal use only."""
+  __slots__ = ("_containingDir", "_entries", "_itIndex")
   
   def __init__(self, containingDir):
     """Constructs a new directory entry list for the specified directory."""
@@ -32,7 +33,7 @@ class _EntryList(object):
       blockId = containingDir._inode.lookupBlockId(i)
       if blockId == 0:
         break
-      blockBytes = containingDir._fs._readBlock(blockId)
+      blockBytes = containingDir._fs._readBlock(blockId, origin = "directory")
       offset = 0
       while offset < containingDir._fs.blockSize:
         entry = _Entry(i, blockId, offset, prevEntry, blockBytes[offset:], containingDir)
@@ -81,7 +82,7 @@ class _EntryList(object):
       entryOffset = lastEntry._offset + lastSize
       entrySize = self._containingDir._fs.blockSize - entryOffset
     else:
-      entryBlockId = self._containingDir._fs._allocateBlock(True)
+      entryBlockId = self._containingDir._fs._allocateBlockFor(self._containingDir._inode, True)
       entryBlockIndex = self._containingDir._inode.assignNextBlockId(entryBlockId)
       self._containingDir._inode.size += self._containingDir._fs.blockSize
       entryOffset = 0
@@ -97,7 +98,7 @@ class _EntryList(object):
         fileType = 1
     
     byteString = pack("<IHBB{0}s".format(nameLength), inode.number, entrySize, nameLength, fileType, name)
-    self._containingDir._fs._writeToBlock(entryBlockId, entryOffset, byteString)
+    self._containingDir._fs._writeToBlock(entryBlockId, entryOffset, byteString, "directory")
     newEntry = _Entry(entryBlockIndex, entryBlockId, entryOffset, None, byteString, self._containingDir)
     newEntry.nextEntry = None
     newEntry.prevEntry = lastEntry
@@ -118,6 +119,8 @@ class _EntryList(object):
 
 class _Entry(object):
   """Represents a directory entry in a linked entry list on the Ext2 filesystem. For internal use only."""
+  __slots__ = ("_fileType", "_name", "_inodeNum", "_size", "_bindex", "_bid", "_offset", "_containingDir",
+               "_nextEntry", "_prevEntry")
 
   @property
   def size(self):
@@ -199,7 +202,7 @@ class _Entry(object):
   
   def __writeData(self, offset, byteString):
     """Writes the specified byte string to the offset within the entry."""
-    self._containingDir._fs._writeToBlock(self._bid, self._offset + offset, byteString)
+    self._containingDir._fs._writeToBlock(self._bid, self._offset + offset, byteString, "directory")
 
     
 
@@ -208,6 +211,7 @@ class _Entry(object):
 
 class Ext2Directory(Ext2File):
   """Represents a directory on the Ext2 filesystem."""
+  __slots__ = ("_entryList",)
 
   @property
   def isDir(self):
@@ -317,10 +321,13 @@ class Ext2Directory(Ext2File):
       rmFile._inode.numLinks -= 1
     
     if rmFile._inode.numLinks <= 0:
+      self._fs._delayedFiles.pop(rmFile._inode.number, None)
+      rmFile._inode.delayedBytes = None
+      self._fs._releasePreallocation(rmFile._inode.number)
       if not rmFile.isSymlink or rmFile._inode.size > 60:
-        for bid in rmFile._inode.usedBlocks():
-          self._fs._freeBlock(bid)
+        self._fs._freeBlocks(rmFile._inode.usedBlocks())
       rmFile._inode.free()
+    self._fs._endOperation()
 
 
 
@@ -345,6 +352,7 @@ class Ext2Directory(Ext2File):
         if entry.name == "..":
           entry.inodeNum = fromFile.parentDir._inode.number
           break
+    self._fs._endOperation()
 
 
 
@@ -373,7 +381,8 @@ class Ext2Directory(Ext2File):
     inode = self._fs._readInode(entry._inodeNum)
     inode.numLinks += 1
     inode.size += self._fs.blockSize
-    self._fs._writeToBlock(inode.lookupBlockId(0), 0, defaultEntries)
+    self._fs._writeToBlock(inode.lookupBlockId(0), 0, defaultEntries, "directory")
+    self._fs._endOperation()
     return Ext2Directory._openEntry(entry, self._fs)
 
 
@@ -400,6 +409,7 @@ class Ext2Directory(Ext2File):
     mode |= 0x8000 # set regular file
 
     entry = self.__makeNewEntry(name, mode, uid, gid, False, creationTime, modTime, accessTime)
+    self._fs._endOperation()
     return Ext2Directory._openEntry(entry, self._fs)
 
 
@@ -410,6 +420,7 @@ class Ext2Directory(Ext2File):
     inode = linkedFile._inode
     entry = self._entryList.append(name, inode)
     inode.numLinks += 1
+    self._fs._endOperation()
     return Ext2Directory._openEntry(entry, self._fs)
 
 
@@ -447,6 +458,7 @@ class Ext2Directory(Ext2File):
       # only support allocating single block for max symlink path length of the block size
       self._fs._writeToBlock(inode.lookupBlockId(0), 0, pack("<{0}s".format(size), linkedPath))
     
+    self._fs._endOperation()
     return Ext2Directory._openEntry(entry, self._fs)
 
 
@@ -487,7 +499,7 @@ class Ext2Directory(Ext2File):
     
     inode = self._fs._allocateInode(mode, uid, gid, creationTime, modTime, accessTime)
     if allocateBlock:
-      bid = self._fs._allocateBlock(True)
+      bid = self._fs._allocateBlockFor(inode, True)
       inode.assignNextBlockId(bid)
     
     entry = self._entryList.append(name, inode)
@@ -10,8 +10,13 @@ from time import localtime, strftime
 from ..error import *
 
 
+_permissionChars = [(0x0100, "r"), (0x0080, "w"), (0x0040, "x"), (0x0020, "r"), (0x0010, "w"), (0x0008, "x"),
+                    (0x0004, "r"), (0x0002, "w"), (0x0001, "x")]
+
 class Ext2File(object):
-  """Represents a file or directory on the Ext2 filesystem."""
+  """Represents a file or directory on the Ext2 filesystem. File objects are kept small with
+  __slots__; the absolute path and mode string are derived when they are requested."""
+  __slots__ = ("_fs", "_inode", "_dirEntry", "_name", "_parentDir")
 
   @property
   def fsType(self):
@@ -27,7 +32,12 @@ class Ext2File(object):
   def absolutePath(self):
     """Gets the absolute path to this file or directory, including the name if
     it is a file or symlink."""
-    return self._path
+    if not self._dirEntry:
+      return "/"
+    parentPath = self._parentDir.absolutePath
+    if parentPath == "/":
+      parentPath = ""
+    return "{0}/{1}".format(parentPath, self._dirEntry.name)
 
   @property
   def inodeNum(self):
@@ -62,7 +72,14 @@ class Ext2File(object):
   @property
   def modeStr(self):
     """Gets a string representing the file object's mode."""
-    return "".join(self._modeStr)
+    mode = self._inode.mode
+    if self.isDir:
+      fileType = "d"
+    elif self.isSymlink:
+      fileType = "l"
+    else:
+      fileType = "-"
+    return fileType + "".join([char if (mode & bit) != 0 else "-" for bit, char in _permissionChars])
 
   @property
   def numLinks(self):
@@ -124,6 +141,7 @@ class Ext2File(object):
     mode = self._inode.mode & 0xFE00 # save non-permission bits of current mode
     mode |= (value & 0x1FF) # set permission bits from new mode
     self._inode.mode = mode
+    self._fs._endOperation()
 
   @property
   def uid(self):
@@ -133,6 +151,7 @@ class Ext2File(object):
   def uid(self, value):
     """Sets the uid of the file owner."""
     self._inode.uid = value
+    self._fs._endOperation()
 
   @property
   def gid(self):
@@ -142,6 +161,7 @@ class Ext2File(object):
   def gid(self, value):
     """Sets the gid of the file owner."""
     self._inode.gid = value
+    self._fs._endOperation()
 
   def __init__(self, dirEntry, inode, fs):
     """Constructs a new file object from the specified entry and inode."""
@@ -161,46 +181,15 @@ class Ext2File(object):
       elif self._name == "..":
         self._dirEntry = dirEntry.containingDir.parentDir._dirEntry
 
-    # determine absolute path to file
+    # determine parent directory
     if self._dirEntry:
       self._parentDir = self._dirEntry.containingDir
-      if self._parentDir.absolutePath == "/":
-        parentPath = ""
-      else:
-        parentPath = self._parentDir.absolutePath
-      self._path = "{0}/{1}".format(parentPath, self._dirEntry.name)
     else:
       self._parentDir = self
-      self._path = "/"
     
     if not self._parentDir.isDir:
       raise FilesystemError("Invalid parent directory.")
     
-
-    self._modeStr = list("----------")
-    if self.isDir:
-      self._modeStr[0] = "d"
-    elif self.isSymlink:
-      self._modeStr[0] = "l"
-    if (self._inode.mode & 0x0100) != 0:
-      self._modeStr[1] = "r"
-    if (self._inode.mode & 0x0080) != 0:
-      self._modeStr[2] = "w"
-    if (self._inode.mode & 0x0040) != 0:
-      self._modeStr[3] = "x"
-    if (self._inode.mode & 0x0020) != 0:
-      self._modeStr[4] = "r"
-    if (self._inode.mode & 0x0010) != 0:
-      self._modeStr[5] = "w"
-    if (self._inode.mode & 0x0008) != 0:
-      self._modeStr[6] = "x"
-    if (self._inode.mode & 0x0004) != 0:
-      self._modeStr[7] = "r"
-    if (self._inode.mode & 0x0002) != 0:
-      self._modeStr[8] = "w"
-    if (self._inode.mode & 0x0001) != 0:
-      self._modeStr[9] = "x"
-    
   
   def files(self):
     """Generates a list of files in the directory."""
@@ -236,8 +225,9 @@ class Ext2File(object):
     raise InvalidFileTypeError()
   
   
-  def blocks(self):
-    """Generates a list of data blocks in the file."""
+  def blocks(self, chunkSize = None):
+    """Generates a list of data blocks in the file, or of chunks of up to chunkSize bytes if
+    specified."""
     raise InvalidFileTypeError()
 
 
@@ -249,5 +239,17 @@ class Ext2File(object):
 
   def getLinkedPath(self):
     """Gets the file path linked to by this symbolic link."""
+
+
+  def sync(self):
+    """Writes changes to this file, and every other change held in memory, to the device."""
+    self._fs.sync()
+
+
+  def close(self):
+    """Frees any blocks preallocated for the file that it has not used and writes its inode if it has
+    changed. The file can still be written to afterwards."""
+    self._fs._releasePreallocation(self._inode.number)
+    self._inode.write()
     
   
@@ -12,39 +12,148 @@ from .file import Ext2File
 
 class Ext2RegularFile(Ext2File):
   """Represents a regular file on the Ext2 filesystem."""
+  __slots__ = ("_readAheadBlocks", "_delayedAllocation")
+  DEFAULT_READ_AHEAD = 256
+  MAX_DELAYED_BYTES = 16 * 1024 * 1024
 
   @property
   def isRegular(self):
     """Gets whether the file object is a regular file."""
     return True
+
+  @property
+  def size(self):
+    """Gets the size of the file in bytes, including data held for delayed allocation."""
+    if self._inode.delayedBytes is None:
+      return self._inode.size
+    return max(self._inode.size, self._inode.delayedStart + len(self._inode.delayedBytes))
+
+  @property
+  def numBlocks(self):
+    """Gets the number of blocks used for data in the file, including the blocks that data held for
+    delayed allocation will take once it is written."""
+    return (self.size + self._fs.blockSize - 1) / self._fs.blockSize
+
+  @property
+  def readAheadBlocks(self):
+    """Gets the maximum number of blocks read from the device at once when reading the file."""
+    return self._readAheadBlocks
+  @readAheadBlocks.setter
+  def readAheadBlocks(self, value):
+    """Sets the maximum number of blocks read from the device at once when reading the file."""
+    if value < 1:
+      raise FilesystemError("Read-ahead window must be at least one block.")
+    self._readAheadBlocks = value
+
+  @property
+  def delayedAllocation(self):
+    """Gets whether writes are held in memory and only given blocks when the file is flushed."""
+    return self._delayedAllocation
+  @delayedAllocation.setter
+  def delayedAllocation(self, value):
+    """Sets whether writes are held in memory and only given blocks when the file is flushed. Any
+    data already held is written when the mode is turned off."""
+    self._delayedAllocation = value
+    if not value:
+      self.flush()
   
   def __init__(self, dirEntry, inode, fs):
     """Constructs a new regular file object from the specified directory entry."""
     super(Ext2RegularFile, self).__init__(dirEntry, inode, fs)
     if (self._inode.mode & 0x8000) != 0x8000:
       raise FilesystemError("Inode does not point to a regular file.")
+    self._readAheadBlocks = Ext2RegularFile.DEFAULT_READ_AHEAD
+    self._delayedAllocation = False
+
 
+  def blocks(self, chunkSize = None):
+    """Generates a list of data blocks in the file, or of chunks of up to chunkSize bytes if
+    specified. Runs of blocks that are contiguous on the device are read with a single read."""
+    self.flush()
+    blockSize = self._fs.blockSize
+    if chunkSize is None:
+      chunkSize = blockSize
+    remaining = self.size
+    for run in self.__readRuns():
+      if len(run) > remaining:
+        run = run[:remaining]
+      remaining -= len(run)
+      for offset in range(0, len(run), chunkSize):
+        yield run[offset:offset+chunkSize]
 
-  def blocks(self):
-    """Generates a list of data blocks in the file."""
-    for i in range(self.numBlocks):
-      blockId = self._inode.lookupBlockId(i)
-      if blockId == 0:
+
+  def __readRuns(self):
+    """Generates the file data as byte strings, one for each run of blocks that are contiguous on
+    the device, with runs longer than the read-ahead window split into reads of that many blocks."""
+    numBlocks = self.numBlocks
+    for logicalStart, startBid, count in self._inode.blockRuns():
+      if logicalStart >= numBlocks:
         break
-      block = self._fs._readBlock(blockId)
-      if (i+1) * self._fs.blockSize > self.size:
-        block = block[:(self.size % self._fs.blockSize)]
-      yield block
+      count = min(count, numBlocks - logicalStart)
+      for offset in range(0, count, self._readAheadBlocks):
+        yield self._fs._readBlockRun(startBid + offset, min(self._readAheadBlocks, count - offset))
 
 
   def write(self, byteString, position = None):
     """Writes the specified string of bytes to the specified position in the file, or at the end
-    if no position is specified"""
+    if no position is specified. In delayed allocation mode, consecutive writes are held in memory
+    until the file is flushed, closed or synced, the filesystem is synced or unmounted, or more than
+    MAX_DELAYED_BYTES are held; blocks for all of them are then allocated at once. The held data
+    belongs to the inode, so it is shared by every file object open on it."""
     
     if position is None:
-      position = self._inode.size
+      position = self.size
     
+    inode = self._inode
+    if self._delayedAllocation:
+      if not inode.delayedBytes is None and position != inode.delayedStart + len(inode.delayedBytes):
+        self.flush()
+      if inode.delayedBytes is None:
+        inode.delayedBytes = bytearray()
+        inode.delayedStart = position
+      self._fs._delayedFiles[inode.number] = self
+      inode.delayedBytes.extend(byteString)
+      if len(inode.delayedBytes) > Ext2RegularFile.MAX_DELAYED_BYTES:
+        self.flush()
+    else:
+      self.flush()
+      self.__write(byteString, position)
+      self._fs._endOperation()
+
+
+  def flush(self):
+    """Allocates blocks for and writes any data held for delayed allocation on the file's inode,
+    whichever file object it was written through."""
+    if self._inode.delayedBytes is None:
+      return
+    byteString = buffer(self._inode.delayedBytes)
+    self._inode.delayedBytes = None
+    self._fs._delayedFiles.pop(self._inode.number, None)
+    self.__write(byteString, self._inode.delayedStart)
+    self._fs._endOperation()
+
+
+  def sync(self):
+    """Writes any data held for delayed allocation, then writes changes to this file that are held in
+    memory to the device."""
+    self.flush()
+    super(Ext2RegularFile, self).sync()
+
+
+  def close(self):
+    """Writes any data held for delayed allocation and frees any blocks preallocated for the file
+    that it has not used."""
+    self.flush()
+    super(Ext2RegularFile, self).close()
+
+
+  def __write(self, byteString, position):
+    """Allocates the blocks needed to write the specified string of bytes at the specified position
+    and writes it, one block-sized slice at a time."""
     totalLength = len(byteString)
+    if totalLength > 0:
+      self.__allocateBlocksTo((position + totalLength - 1) / self._fs.blockSize)
+    
     written = 0
     while written < totalLength:
       blockIndex = position / self._fs.blockSize
@@ -52,15 +161,39 @@ class Ext2RegularFile(Ext2File):
 
       bid = self._inode.lookupBlockId(blockIndex)
       while bid == 0:
-        self._inode.assignNextBlockId(self._fs._allocateBlock())
+        self._inode.assignNextBlockId(self._fs._allocateBlockFor(self._inode))
         bid = self._inode.lookupBlockId(blockIndex)
       
-      numBytesToWrite = min(len(byteString), self._fs.blockSize - byteIndex)
-      bytesToWrite = byteString[:numBytesToWrite]
-      byteString = byteString[numBytesToWrite:]
-      self._fs._writeToBlock(bid, byteIndex, bytesToWrite)
-      self._inode.size = max(position + numBytesToWrite, self._inode.size)
+      numBytesToWrite = min(totalLength - written, self._fs.blockSize - byteIndex)
+      self._fs._writeToBlock(bid, byteIndex, byteString[written:written+numBytesToWrite])
       written += numBytesToWrite
       position += numBytesToWrite
+    
+    if written > 0 and position > self._inode.size:
+      self._inode.size = position
       
     
+
+
+
+  def __allocateBlocksTo(self, lastBlockIndex):
+    """Allocates any missing blocks up to and including the specified block index, together with
+    the indirect blocks that map them, as contiguous extents placed after the file's last block or
+    in its preallocation window where possible. Each new indirect block is placed just before the
+    data blocks it maps, and the data blocks are assigned to the file in order."""
+    inode = self._inode
+    numAllocated = (inode.size + self._fs.blockSize - 1) / self._fs.blockSize
+    while inode.lookupBlockId(numAllocated) != 0:
+      numAllocated += 1
+    if lastBlockIndex < numAllocated:
+      return
+    indexes = range(numAllocated, lastBlockIndex + 1)
+    count = len(indexes) + sum([inode.numIndirectBlocksAt(index) for index in indexes])
+    bids = []
+    for start, length in self._fs._allocateBlocksFor(inode, count):
+      bids.extend(range(start, start + length))
+    position = 0
+    for index in indexes:
+      numIndirect = inode.numIndirectBlocksAt(index)
+      inode.assignNextBlockId(bids[position+numIndirect], bids[position:position+numIndirect])
+      position += numIndirect + 1
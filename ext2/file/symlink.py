@@ -13,6 +13,7 @@ from .file import Ext2File
 
 class Ext2Symlink(Ext2File):
   """Represents a symbolic link to a file or directory on the Ext2 filesystem."""
+  __slots__ = ()
 
   @property
   def isSymlink(self):
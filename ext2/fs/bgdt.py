@@ -6,14 +6,92 @@ __license__ = "BSD"
 __copyright__ = "Copyright 2013, Michael R. Falcone"
 
 
-from struct import pack,unpack_from
+from struct import pack,pack_into,unpack_from
 from math import ceil
-from time import time
+from array import array
 from ..error import FilesystemError
 
 
+class _GroupIndex(object):
+  """Holds one counter per block group in an array, together with a tree of the maximum counter
+  over each range of groups, so that the first group at or after a given group whose counter is at
+  least a given value can be found in O(log groups). The counters are stored with the specified
+  array typecode. For internal use only."""
+
+  def __init__(self, values, typecode = "l"):
+    """Constructs a new index over the specified list or array of counters."""
+    self._numGroups = len(values)
+    self._size = 1
+    while self._size < self._numGroups:
+      self._size <<= 1
+    self._tree = array(typecode, [0]) * (2 * self._size)
+    self._tree[self._size:self._size+self._numGroups] = array(typecode, values)
+    for i in range(self._size - 1, 0, -1):
+      self._tree[i] = max(self._tree[2*i], self._tree[2*i+1])
+
+
+  def __len__(self):
+    """Gets the number of groups in the index."""
+    return self._numGroups
+
+
+  @property
+  def maximum(self):
+    """Gets the largest counter of any group."""
+    return self._tree[1]
+
+
+  def __getitem__(self, groupNum):
+    """Gets the counter of the specified group."""
+    return self._tree[self._size + groupNum]
+
+
+  def __setitem__(self, groupNum, value):
+    """Sets the counter of the specified group and updates the maximums above it."""
+    tree = self._tree
+    i = self._size + groupNum
+    tree[i] = value
+    i >>= 1
+    while i > 0:
+      maximum = max(tree[2*i], tree[2*i+1])
+      if tree[i] == maximum:
+        break
+      tree[i] = maximum
+      i >>= 1
+
+
+  def findFirst(self, start = 0, minimum = 1):
+    """Returns the number of the first group at or after start whose counter is at least minimum,
+    or None if there is no such group."""
+    if start >= self._numGroups:
+      return None
+    tree = self._tree
+    i = self._size + start
+    if tree[i] >= minimum:
+      return start
+    
+    # climb until a right sibling holds a large enough counter
+    while True:
+      if i & 1 == 0 and tree[i+1] >= minimum:
+        i += 1
+        break
+      i >>= 1
+      if i <= 1:
+        return None
+    
+    # descend to the leftmost such group
+    while i < self._size:
+      i <<= 1
+      if tree[i] < minimum:
+        i += 1
+    return i - self._size
+
+
+
 class _BGDTEntry(object):
   """Models an entry in the block group descriptor table. For internal use only."""
+  __slots__ = ("_superblock", "_device", "_groupNum", "_blockBitmapBid", "_inodeBitmapBid", "_inodeTableBid",
+               "_freeBlockCounts", "_freeInodesIndex", "_numInodesAsDirs")
 
   @property
   def blockBitmapLocation(self):
@@ -33,23 +111,23 @@ class _BGDTEntry(object):
   @property
   def numFreeBlocks(self):
     """Gets the number of free blocks."""
-    return self._numFreeBlocks
+    return self._freeBlockCounts[self._groupNum]
   @numFreeBlocks.setter
   def numFreeBlocks(self, value):
     """Sets the number of free blocks."""
-    self._numFreeBlocks = value
-    self.__writeData(12, pack("<H", self._numFreeBlocks))
+    self._freeBlockCounts[self._groupNum] = value
+    self.__writeData(12, pack("<H", value))
 
 
   @property
   def numFreeInodes(self):
     """Gets the number of free inodes."""
-    return self._numFreeInodes
+    return self._freeInodesIndex[self._groupNum]
   @numFreeInodes.setter
   def numFreeInodes(self, value):
     """Sets the number of free inodes."""
-    self._numFreeInodes = value
-    self.__writeData(14, pack("<H", self._numFreeInodes))
+    self._freeInodesIndex[self._groupNum] = value
+    self.__writeData(14, pack("<H", value))
 
 
   @property
@@ -63,29 +141,26 @@ class _BGDTEntry(object):
     self.__writeData(16, pack("<H", self._numInodesAsDirs))
     
   
-  def __init__(self, startPos, device, superblock, fields):
-    """Creates a new BGDT entry from the given fields."""
+  def __init__(self, startPos, device, superblock, fields, freeBlockCounts, freeInodesIndex):
+    """Creates a new BGDT entry from the given fields. The free block counts are kept in the
+    specified array and the free inode counts in the specified group index, which must already
+    hold them."""
     self._superblock = superblock
     self._device = device
-    self._startPos = startPos
+    self._groupNum = startPos / 32
     self._blockBitmapBid = fields[0]
     self._inodeBitmapBid = fields[1]
     self._inodeTableBid = fields[2]
-    self._numFreeBlocks = fields[3]
-    self._numFreeInodes = fields[4]
+    self._freeBlockCounts = freeBlockCounts
+    self._freeInodesIndex = freeInodesIndex
     self._numInodesAsDirs = fields[5]
 
 
   def __writeData(self, offset, byteString):
     """Writes the specified string of bytes at the specified offset (from the start of the bgdt entry bytes)
-    on the device."""
-    for groupId in self._superblock.copyLocations:
-      groupStart = groupId * self._superblock.numBlocksPerGroup * self._superblock.blockSize
-      tableStart = groupStart + (self._superblock.blockSize * (self._superblock.firstDataBlockId + 1))
-      self._device.write(tableStart + self._startPos + offset, byteString)
-      if not self._superblock._saveCopies:
-        break
-    self._superblock.timeLastWrite = int(time())
+    in the primary table on the device. The shadow tables are only rewritten by _BGDT.writeCopies()."""
+    tableStart = self._superblock.blockSize * (self._superblock.firstDataBlockId + 1)
+    self._device.write(tableStart + self._groupNum * 32 + offset, byteString)
 
 
 
@@ -98,6 +173,11 @@ class _BGDT(object):
     """Gets the list of BGDT entries. Indexes are block group ids."""
     return self._entries
 
+  @property
+  def freeInodesIndex(self):
+    """Gets the index of the number of free inodes in each block group."""
+    return self._freeInodesIndex
+
 
   @classmethod
   def new(cls, bgNumCopy, superblock, device):
@@ -109,6 +189,7 @@ class _BGDT(object):
     inodeTableBlocks = int(ceil(float(superblock.numInodesPerGroup * superblock.inodeSize) / superblock.blockSize))
 
     bgdtBytes = ""
+    bitmapWrites = []
     for bgroupNum in range(superblock.numBlockGroups):
       
       bgroupStartBid = bgroupNum * superblock.numBlocksPerGroup + superblock.firstDataBlockId
@@ -160,7 +241,7 @@ class _BGDT(object):
           blockBitmap[padBitIndex >> 8] |= (1 << (padBitIndex & 0x07))
           padBitIndex += 1
         blockBitmapBytes = "".join(map(pack, fmt, blockBitmap))
-        device.write(blockBitmapLocation * superblock.blockSize, blockBitmapBytes)
+        bitmapWrites.append((blockBitmapLocation * superblock.blockSize, blockBitmapBytes))
 
         inodeBitmap = [0] * superblock.blockSize
         bitmapIndex = 0
@@ -170,7 +251,7 @@ class _BGDT(object):
           if (i+1) % 8 == 0:
             bitmapIndex += 1
         inodeBitmapBytes = "".join(map(pack, fmt, inodeBitmap))
-        device.write(inodeBitmapLocation * superblock.blockSize, inodeBitmapBytes)
+        bitmapWrites.append((inodeBitmapLocation * superblock.blockSize, inodeBitmapBytes))
         
       entryBytes = pack("<3I3H", blockBitmapLocation, inodeBitmapLocation, inodeTableLocation,
                         numFreeBlocks, numFreeInodes, numInodesAsDirs)
@@ -178,6 +259,7 @@ class _BGDT(object):
       fmt = ["B"] * 14
       bgdtBytes = "{0}{1}{2}".format(bgdtBytes, entryBytes, "".join(map(pack, fmt, zeros)))
     
+    device.writeMany(bitmapWrites)
     device.write(startPos, bgdtBytes)
     
     return cls(bgdtBytes, superblock, device)
@@ -196,10 +278,29 @@ class _BGDT(object):
   
   def __init__(self, bgdtBytes, superblock, device):
     """Constructs a new BGDT from the given byte array."""
+    self._superblock = superblock
+    self._device = device
+    self._tableBytes = bytearray(bgdtBytes[:superblock.numBlockGroups * 32])
+    fieldsList = [unpack_from("<3I3H", bgdtBytes, i * 32) for i in range(superblock.numBlockGroups)]
+    self._freeBlockCounts = array("l", [fields[3] for fields in fieldsList])
+    self._freeInodesIndex = _GroupIndex([fields[4] for fields in fieldsList])
     self._entries = []
-    for i in range(superblock.numBlockGroups):
-      startPos = i * 32
-      fields = unpack_from("<3I3H", bgdtBytes, startPos)
-      self._entries.append(_BGDTEntry(startPos, device, superblock, fields))
+    for i, fields in enumerate(fieldsList):
+      self._entries.append(_BGDTEntry(i * 32, device, superblock, fields, self._freeBlockCounts,
+                                      self._freeInodesIndex))
 
 
+  def writeCopies(self):
+    """Rewrites the table in every backup block group from the current entries, with one write per
+    copy."""
+    tableBytes = self._tableBytes
+    for i, entry in enumerate(self._entries):
+      pack_into("<3I3H", tableBytes, i * 32, entry.blockBitmapLocation, entry.inodeBitmapLocation,
+                entry.inodeTableLocation, entry.numFreeBlocks, entry.numFreeInodes, entry.numInodesAsDirs)
+    writes = []
+    for groupId in self._superblock.copyLocations:
+      if groupId == 0:
+        continue
+      startPos = (groupId * self._superblock.numBlocksPerGroup + self._superblock.firstDataBlockId + 1) * self._superblock.blockSize
+      writes.append((startPos, str(tableBytes)))
+    self._device.writeMany(writes)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Defines the in-memory bitmap class used by the ext2 module.
+"""
+__license__ = "BSD"
+__copyright__ = "Copyright 2013, Michael R. Falcone"
+
+
+import re
+from struct import pack
+
+
+_notFull = re.compile("[^\xff]")
+_lowestZeroBit = [min([i for i in range(9) if i == 8 or (byte >> i) & 1 == 0]) for byte in range(256)]
+
+
+class _Bitmap(object):
+  """Holds the block or inode bitmap of one block group in memory as a mutable buffer. Free bits are
+  found by searching for the first byte that is not 0xFF and looking up its lowest zero bit. Changes
+  are either written through to the device one byte at a time or held until write() is called.
+  For internal use only."""
+
+  @property
+  def bytes(self):
+    """Gets the bitmap's buffer."""
+    return self._bytes
+
+  @property
+  def isDirty(self):
+    """Gets whether the bitmap has changes that have not been written to the device."""
+    return self._isDirty
+
+
+  def __init__(self, bitmapBytes, device, position, numBits, writeThrough):
+    """Constructs a new bitmap from the specified bytes, which were read from the specified
+    position on the device. Only the first numBits bits are in use."""
+    self._bytes = bytearray(bitmapBytes[:(numBits + 7) / 8])
+    self._device = device
+    self._position = position
+    self._numBits = numBits
+    self._writeThrough = writeThrough
+    self._isDirty = False
+
+
+  def isSet(self, index):
+    """Returns whether the specified bit is set."""
+    return self._bytes[index >> 3] & (1 << (index & 7)) != 0
+
+
+  def set(self, index):
+    """Sets the specified bit."""
+    self._bytes[index >> 3] |= (1 << (index & 7))
+    self.__changed(index >> 3)
+
+
+  def clear(self, index):
+    """Clears the specified bit."""
+    self._bytes[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+    self.__changed(index >> 3)
+
+
+  def setRange(self, start, count):
+    """Sets count bits starting at the specified bit, filling whole bytes at once."""
+    self.__changeRange(start, count, True)
+
+
+  def clearRange(self, start, count):
+    """Clears count bits starting at the specified bit, filling whole bytes at once."""
+    self.__changeRange(start, count, False)
+
+
+  def clearRanges(self, ranges):
+    """Clears the bits of each (start, count) pair in a list sorted by start, then writes the
+    changed bytes through to the device with one write or marks the bitmap dirty."""
+    if len(ranges) == 0:
+      return
+    for start, count in ranges:
+      self.__fillRange(start, count, False)
+    lastStart, lastCount = ranges[-1]
+    self.__changedRange(ranges[0][0] >> 3, (lastStart + lastCount - 1) >> 3)
+
+
+  def findFirstZero(self, start = 0):
+    """Returns the index of the first clear bit at or after start, or None if every bit is set."""
+    if start >= self._numBits:
+      return None
+    byteIndex = start >> 3
+    byte = self._bytes[byteIndex] | ((1 << (start & 7)) - 1)
+    if byte == 0xFF:
+      match = _notFull.search(self._bytes, byteIndex + 1)
+      if match is None:
+        return None
+      byteIndex = match.start()
+      byte = self._bytes[byteIndex]
+    index = (byteIndex << 3) + _lowestZeroBit[byte]
+    if index >= self._numBits:
+      return None
+    return index
+
+
+  def write(self):
+    """Writes the whole bitmap to the device if it has changed."""
+    if self._isDirty:
+      self._device.write(self._position, str(self._bytes))
+      self._isDirty = False
+
+
+  def __changeRange(self, start, count, value):
+    """Sets or clears count bits starting at the specified bit, then writes the changed bytes through
+    to the device with one write or marks the bitmap dirty."""
+    self.__fillRange(start, count, value)
+    self.__changedRange(start >> 3, (start + count - 1) >> 3)
+
+
+  def __fillRange(self, start, count, value):
+    """Sets or clears count bits starting at the specified bit in memory."""
+    end = start + count
+    bitmapBytes = self._bytes
+    index = start
+    while index < end and index & 7 != 0:
+      if value:
+        bitmapBytes[index >> 3] |= (1 << (index & 7))
+      else:
+        bitmapBytes[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+      index += 1
+    wholeEnd = end & ~7
+    if index < wholeEnd:
+      bitmapBytes[index >> 3:wholeEnd >> 3] = ("\xff" if value else "\0") * ((wholeEnd - index) >> 3)
+      index = wholeEnd
+    while index < end:
+      if value:
+        bitmapBytes[index >> 3] |= (1 << (index & 7))
+      else:
+        bitmapBytes[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+      index += 1
+
+
+  def __changedRange(self, firstByte, lastByte):
+    """Writes the changed bytes from firstByte to lastByte through to the device or marks the bitmap
+    dirty."""
+    if self._writeThrough:
+      self._device.write(self._position + firstByte, str(self._bytes[firstByte:lastByte+1]))
+    else:
+      self._isDirty = True
+
+
+  def __changed(self, byteIndex):
+    """Writes the changed byte through to the device or marks the bitmap dirty."""
+    if self._writeThrough:
+      self._device.write(self._position + byteIndex, pack("B", self._bytes[byteIndex]))
+    else:
+      self._isDirty = True
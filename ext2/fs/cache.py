@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Defines the block cache placed between the filesystem and its device.
+"""
+__license__ = "BSD"
+__copyright__ = "Copyright 2013, Michael R. Falcone"
+
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class _BlockCache(object):
+  """Caches whole blocks read from a device, keyed by block id, and evicts the least recently
+  used block once the maximum number of blocks is reached. Provides the same read/write interface
+  as the device so that it can be used in place of it. In write-back mode, written blocks are kept
+  dirty in the cache until they are flushed or evicted, and discarded ranges are only discarded on
+  the device once the next flush has written them; otherwise every write and discard is passed to
+  the device and flushed immediately. If an _IOStats object is given, the origin set on it when a block
+  is dirtied is restored when the block is written back. For internal use only."""
+
+  DEFAULT_SIZE = 1024
+
+
+  @property
+  def blockSize(self):
+    """Gets the size in bytes of the cached blocks."""
+    return self._blockSize
+
+  @property
+  def size(self):
+    """Gets the size of the underlying device in bytes."""
+    return self._device.size
+
+  @property
+  def maxBlocks(self):
+    """Gets the maximum number of blocks held by the cache."""
+    return self._maxBlocks
+
+  @property
+  def numBlocks(self):
+    """Gets the number of blocks currently held by the cache."""
+    return len(self._blocks)
+
+  @property
+  def numDirtyBlocks(self):
+    """Gets the number of cached blocks that have not been written to the device."""
+    return len(self._dirty)
+
+  @property
+  def writeBack(self):
+    """Gets whether writes are held in the cache until flushed."""
+    return self._writeBack
+
+  @property
+  def hits(self):
+    """Gets the number of block lookups answered from the cache."""
+    return self._hits
+
+  @property
+  def misses(self):
+    """Gets the number of block lookups that had to read from the device."""
+    return self._misses
+
+
+  def __init__(self, device, blockSize, maxBlocks = DEFAULT_SIZE, writeBack = False, stats = None):
+    """Constructs a new block cache over the specified device. If maxBlocks is 0, reads
+    and writes are passed directly to the device and only flushing is left to the cache."""
+    self._device = device
+    self._blockSize = blockSize
+    self._maxBlocks = maxBlocks
+    self._writeBack = writeBack
+    self._blocks = OrderedDict()
+    self._dirty = {}
+    self._discards = []
+    self._stats = stats
+    self._hits = 0
+    self._misses = 0
+
+
+  def read(self, position, size):
+    """Reads a byte string of the specified size from the specified position."""
+    if self._maxBlocks == 0:
+      return self._device.read(position, size)
+
+    firstBid = position / self._blockSize
+    lastBid = (position + size - 1) / self._blockSize
+    offset = position % self._blockSize
+    if firstBid == lastBid:
+      return str(self.__getBlock(firstBid)[offset:offset+size])
+
+    chunks = []
+    for bid in range(firstBid, lastBid + 1):
+      chunks.append(str(self.__getBlock(bid)))
+    return "".join(chunks)[offset:offset+size]
+
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position. In write-back mode the
+    overlapped blocks are only updated in the cache and marked dirty; otherwise the bytes are
+    written to the device and any cached blocks that they overlap are updated."""
+    self.__keepRange(position, len(byteString))
+    if self._maxBlocks == 0:
+      self._device.write(position, byteString)
+      if not self._writeBack:
+        self._device.flush()
+      return
+
+    if not self._writeBack:
+      self._device.write(position, byteString)
+      self._device.flush()
+    self.__writeToCachedBlocks(position, byteString)
+
+
+  def readMany(self, ranges):
+    """Reads the byte strings for a list of (position, size) pairs and returns them in the same
+    order. The cached blocks of a range are taken from the cache; the rest are read from the device
+    in coalesced runs and are not added to the cache, so that long sequential reads do not evict
+    frequently used blocks."""
+    if self._maxBlocks == 0:
+      return self._device.readMany(ranges)
+
+    results = [None] * len(ranges)
+    uncached = []
+    for index, (position, size) in enumerate(ranges):
+      if self.__isCached(position, size):
+        results[index] = self.__readAround(position, size)
+      else:
+        uncached.append(index)
+    deviceResults = self._device.readMany([ranges[index] for index in uncached])
+    for index, byteString in zip(uncached, deviceResults):
+      results[index] = byteString
+    return results
+
+
+  def writeMany(self, writes):
+    """Writes a list of non-overlapping (position, byteString) pairs. Outside of write-back mode,
+    adjacent writes are coalesced on the device and flushed once."""
+    for position, byteString in writes:
+      self.__keepRange(position, len(byteString))
+    if self._maxBlocks == 0 or not self._writeBack:
+      self._device.writeMany(writes)
+      if not self._writeBack:
+        self._device.flush()
+    if self._maxBlocks > 0:
+      for position, byteString in writes:
+        self.__writeToCachedBlocks(position, byteString)
+
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros. In write-back mode
+    the overlapped blocks are zeroed in the cache and marked dirty; otherwise the device zeroes the
+    range and any cached blocks that it overlaps are updated."""
+    self.__keepRange(position, size)
+    if self._maxBlocks == 0 or not self._writeBack:
+      self._device.zero(position, size)
+      if not self._writeBack:
+        self._device.flush()
+    if self._maxBlocks > 0:
+      self.__writeToCachedBlocks(position, bytearray(size))
+
+
+  def discard(self, position, size):
+    """Drops the whole blocks in the specified range from the cache, whether dirty or not, and
+    discards the range on the device. Used for blocks that have been freed. In write-back mode the
+    range is only discarded after the next flush has written the dirty blocks, since the metadata
+    that frees the blocks is still held in the cache; blocks written again before then are kept."""
+    firstBid = position / self._blockSize
+    endBid = (position + size - 1) / self._blockSize + 1
+    for bid in range(firstBid, endBid):
+      self._blocks.pop(bid, None)
+      self._dirty.pop(bid, None)
+    if self._writeBack:
+      index = bisect_left(self._discards, (firstBid,))
+      self._discards.insert(index, (firstBid, endBid))
+    else:
+      self._device.discard(position, size)
+
+
+  def flush(self):
+    """Writes all dirty blocks to the device in block id order, each run of adjacent dirty blocks
+    with a single write, and syncs the device. The pending discards are then sent to the device."""
+    self.__writeBlocks(sorted(self._dirty))
+    self._dirty.clear()
+    self._device.sync()
+    for firstBid, endBid in self._discards:
+      self._device.discard(firstBid * self._blockSize, (endBid - firstBid) * self._blockSize)
+    del self._discards[:]
+
+
+  def invalidate(self):
+    """Drops all cached blocks, including any that are dirty, and any pending discards."""
+    self._blocks.clear()
+    self._dirty.clear()
+    del self._discards[:]
+
+
+  def __keepRange(self, position, size):
+    """Removes the whole blocks overlapped by the specified range from the pending discards, since
+    they are being written again."""
+    if len(self._discards) == 0 or size == 0:
+      return
+    firstBid = position / self._blockSize
+    endBid = (position + size - 1) / self._blockSize + 1
+    first = bisect_left(self._discards, (firstBid,))
+    if first > 0 and self._discards[first-1][1] > firstBid:
+      first -= 1
+    last = first
+    remaining = []
+    while last < len(self._discards) and self._discards[last][0] < endBid:
+      start, end = self._discards[last]
+      if start < firstBid:
+        remaining.append((start, firstBid))
+      if end > endBid:
+        remaining.append((endBid, end))
+      last += 1
+    self._discards[first:last] = remaining
+
+
+  def __writeToCachedBlocks(self, position, byteString):
+    """Copies the specified byte string into the blocks it overlaps. In write-back mode the blocks
+    are loaded if necessary and marked dirty; otherwise only blocks already cached are updated."""
+    end = position + len(byteString)
+    for bid in range(position / self._blockSize, (end - 1) / self._blockSize + 1):
+      blockStart = bid * self._blockSize
+      start = max(position, blockStart)
+      stop = min(end, blockStart + self._blockSize)
+      if self._writeBack:
+        block = self.__getBlock(bid, stop - start < self._blockSize)
+        self._dirty[bid] = self._stats.origin if self._stats else None
+      else:
+        block = self._blocks.get(bid)
+        if block is None:
+          continue
+      block[start-blockStart:stop-blockStart] = byteString[start-position:stop-position]
+
+
+  def __getBlock(self, bid, load = True):
+    """Returns the cached bytes of the specified block id. If the block is not cached, it is read
+    from the device (or zero-filled if load is False) and the least recently used block is evicted.
+    A dirty evicted block is first written to the device with the dirty blocks adjacent to it."""
+    block = self._blocks.pop(bid, None)
+    if block is None:
+      self._misses += 1
+      start = bid * self._blockSize
+      blockLength = min(self._blockSize, self._device.size - start)
+      if load:
+        block = bytearray(self._device.read(start, blockLength))
+      else:
+        block = bytearray(blockLength)
+      if len(self._blocks) >= self._maxBlocks:
+        evictedBid = next(iter(self._blocks))
+        if evictedBid in self._dirty:
+          self.__writeDirtyRun(evictedBid)
+        del self._blocks[evictedBid]
+    else:
+      self._hits += 1
+    self._blocks[bid] = block
+    return block
+
+
+  def __readAround(self, position, size):
+    """Reads the specified range, taking the blocks that are cached from the cache and reading each
+    run of uncached blocks from the device with a single read, without adding it to the cache."""
+    end = position + size
+    chunks = []
+    while position < end:
+      bid = position / self._blockSize
+      if bid in self._blocks:
+        blockStart = bid * self._blockSize
+        stop = min(end, blockStart + self._blockSize)
+        chunks.append(str(self.__getBlock(bid)[position-blockStart:stop-blockStart]))
+      else:
+        stopBid = bid + 1
+        while stopBid * self._blockSize < end and not stopBid in self._blocks:
+          stopBid += 1
+        stop = min(end, stopBid * self._blockSize)
+        chunks.append(str(self._device.read(position, stop - position)))
+      position = stop
+    return "".join(chunks)
+
+
+  def __isCached(self, position, size):
+    """Returns whether any block overlapped by the specified range is cached."""
+    for bid in range(position / self._blockSize, (position + size - 1) / self._blockSize + 1):
+      if bid in self._blocks:
+        return True
+    return False
+
+
+  def __writeDirtyRun(self, bid):
+    """Writes the run of adjacent dirty blocks holding the specified dirty block id to the device
+    and marks them clean."""
+    first = bid
+    while first - 1 in self._dirty:
+      first -= 1
+    last = bid
+    while last + 1 in self._dirty:
+      last += 1
+    bids = range(first, last + 1)
+    self.__writeBlocks(bids)
+    for runBid in bids:
+      del self._dirty[runBid]
+
+
+  def __writeBlocks(self, bids):
+    """Writes the specified sorted dirty block ids to the device with one batched write per run of
+    blocks dirtied with the same origin, so that adjacent blocks are written together."""
+    origin = self._stats.origin if self._stats else None
+    start = 0
+    for i in range(1, len(bids) + 1):
+      if i == len(bids) or self._dirty[bids[i]] != self._dirty[bids[start]]:
+        if self._stats:
+          self._stats.origin = self._dirty[bids[start]]
+        self._device.writeMany([(bid * self._blockSize, str(self._blocks[bid])) for bid in bids[start:i]])
+        start = i
+    if self._stats:
+      self._stats.origin = origin
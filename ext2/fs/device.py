@@ -6,12 +6,95 @@ __license__ = "BSD"
 __copyright__ = "Copyright 2013, Michael R. Falcone"
 
 
+import zlib
 from os import fsync, path, makedirs
-from struct import pack
-from ..error import FilesystemError
+from mmap import mmap
+from struct import pack, unpack, unpack_from
+from collections import OrderedDict
+from ..error import FilesystemError, UnsupportedOperationError
 
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
 
-class _DeviceFromFile(object):
+try:
+  from ctypes import CDLL, c_int, c_longlong
+  from ctypes.util import find_library
+  _libc = CDLL(find_library("c"), use_errno = True)
+  _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+  _fallocate.argtypes = [c_int, c_int, c_longlong, c_longlong]
+except (ImportError, OSError, AttributeError, TypeError):
+  _fallocate = None
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+_FALLOC_FL_ZERO_RANGE = 0x10
+
+
+def _coalesce(requests, sizeOf):
+  """Sorts a list of requests whose first item is a device position and groups those that are
+  adjacent on the device into runs. Returns a list of (runStart, runSize, members) tuples, where
+  members is the list of (index, request) pairs in the run."""
+  runs = []
+  for index, request in sorted(enumerate(requests), key = lambda r: r[1][0]):
+    position = request[0]
+    size = sizeOf(request)
+    if len(runs) > 0 and runs[-1][0] + runs[-1][1] == position:
+      runs[-1][1] += size
+      runs[-1][2].append((index, request))
+    else:
+      runs.append([position, size, [(index, request)]])
+  return [tuple(run) for run in runs]
+
+
+
+class _Device(object):
+  """Base class for devices, providing batched reads and writes in terms of single ones."""
+
+  _numSyscalls = 0
+
+  @property
+  def numSyscalls(self):
+    """Gets the number of host file operations (seeks, reads, writes, flushes, syncs and fallocate
+    calls) issued by the device while mounted, each of which is roughly one system call."""
+    return self._numSyscalls
+
+  def readMany(self, ranges):
+    """Reads the byte strings for a list of (position, size) pairs and returns them in the same
+    order. Ranges that are adjacent on the device are read with a single read."""
+    results = [None] * len(ranges)
+    for runStart, runSize, members in _coalesce(ranges, lambda r: r[1]):
+      runBytes = self.read(runStart, runSize)
+      for index, (position, size) in members:
+        results[index] = runBytes[position-runStart:position-runStart+size]
+    return results
+
+  def writeMany(self, writes):
+    """Writes a list of (position, byteString) pairs, which must not overlap. Writes that are
+    adjacent on the device are joined and written with a single write."""
+    for runStart, runSize, members in _coalesce(writes, lambda w: len(w[1])):
+      self.write(runStart, "".join([str(byteString) for index, (position, byteString) in members]))
+
+  def _getZeros(self, size):
+    """Returns a string of at least the specified number of zero bytes, reusing the last one
+    created if it is long enough."""
+    if len(self._zeroBuffer) < size:
+      self._zeroBuffer = "\0" * size
+    return self._zeroBuffer
+
+  def sync(self):
+    """Flushes any buffered writes to the device at a sync point, such as a filesystem sync or
+    unmount. The same as flush() unless the device has a more expensive way of making writes
+    durable."""
+    self.flush()
+
+
+
+class _DeviceFromFile(_Device):
   """Represents a device from a filesystem image file."""
   
   @property
@@ -19,6 +102,11 @@ class _DeviceFromFile(object):
     """Returns whether the device is currently mounted."""
     return (not self._imageFile is None)
 
+  @property
+  def size(self):
+    """Gets the size of the device in bytes."""
+    return self._imageSize
+
   @classmethod
   def makeNew(cls, imageFilename, numBytes):
     """Creates a new device image with the specified filename."""
@@ -41,6 +129,9 @@ class _DeviceFromFile(object):
     """Constructs a new device object from the specified file."""
     self._imageFilename = filename
     self._imageFile = None
+    self._zeroBuffer = ""
+    self._canZeroRange = _fallocate is not None
+    self._canPunchHoles = _fallocate is not None
   
   def mount(self):
     """Opens reading/writing from/to the device."""
@@ -55,6 +146,7 @@ class _DeviceFromFile(object):
       self._imageFile.flush()
       fsync(self._imageFile.fileno())
       self._imageFile.close()
+      self._numSyscalls += 2
     self._imageFile = None
 
   def read(self, position, size):
@@ -62,6 +154,7 @@ class _DeviceFromFile(object):
     assert self.isMounted, "Device not mounted."
     assert position+size <= self._imageSize, "Requested bytes out of range."
     self._imageFile.seek(position)
+    self._numSyscalls += 2
     return self._imageFile.read(size)
   
   def write(self, position, byteString):
@@ -71,4 +164,673 @@ class _DeviceFromFile(object):
       "Invalid device position [device size: {0} bytes].".format(self._imageSize)
     self._imageFile.seek(position)
     self._imageFile.write(byteString)
+    self._numSyscalls += 2
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros, using
+    fallocate(FALLOC_FL_ZERO_RANGE) where it is available."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= self._imageSize, "Requested bytes out of range."
+    if self._canZeroRange:
+      self._imageFile.flush()
+      self._numSyscalls += 2
+      if _fallocate(self._imageFile.fileno(), _FALLOC_FL_KEEP_SIZE | _FALLOC_FL_ZERO_RANGE, position, size) == 0:
+        return
+      self._canZeroRange = False
+    self._imageFile.seek(position)
+    self._imageFile.write(buffer(self._getZeros(size), 0, size))
+    self._numSyscalls += 2
+
+  def discard(self, position, size):
+    """Tells the device that the specified bytes are no longer in use. Where possible, a hole is
+    punched in the image file so that the range reads back as zeros and no longer takes up space
+    on the host; otherwise the bytes are left unchanged."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= self._imageSize, "Requested bytes out of range."
+    if self._canPunchHoles:
+      self._imageFile.flush()
+      self._numSyscalls += 2
+      if _fallocate(self._imageFile.fileno(), _FALLOC_FL_KEEP_SIZE | _FALLOC_FL_PUNCH_HOLE, position, size) != 0:
+        self._canPunchHoles = False
+
+  def flush(self):
+    """Flushes any buffered writes to the device."""
+    assert self.isMounted, "Device not mounted."
     self._imageFile.flush()
+    self._numSyscalls += 1
+
+
+
+class _DeviceFromMappedFile(_DeviceFromFile):
+  """Represents a device from a filesystem image file that is memory-mapped while mounted.
+  Reads return buffer objects into the mapping instead of copies, and writes go directly
+  to the mapped pages. Modified pages are only written to the image file with msync on sync()
+  and unmount, not on every flush()."""
+
+  def __init__(self, filename):
+    """Constructs a new memory-mapped device object from the specified file."""
+    super(_DeviceFromMappedFile, self).__init__(filename)
+    self._map = None
+
+  def mount(self):
+    """Opens the image file and maps it into memory for reading/writing."""
+    super(_DeviceFromMappedFile, self).mount()
+    try:
+      self._map = mmap(self._imageFile.fileno(), self._imageSize)
+    except:
+      self._imageFile.close()
+      self._imageFile = None
+      raise
+
+  def unmount(self):
+    """Flushes and closes the mapping, then closes the image file."""
+    if self._map:
+      self._map.flush()
+      self._map.close()
+      self._numSyscalls += 1
+    self._map = None
+    super(_DeviceFromMappedFile, self).unmount()
+
+  def read(self, position, size):
+    """Returns a buffer of the specified size into the mapping at the specified position. The
+    buffer reflects later writes and must not be used after the device is unmounted."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= self._imageSize, "Requested bytes out of range."
+    return buffer(self._map, position, size)
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position."""
+    assert self.isMounted, "Device not mounted."
+    assert position+len(byteString) <= self._imageSize,\
+      "Invalid device position [device size: {0} bytes].".format(self._imageSize)
+    self._map[position:position+len(byteString)] = byteString
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros."""
+    zeros = self._getZeros(size)
+    self.write(position, zeros if len(zeros) == size else zeros[:size])
+
+  def readMany(self, ranges):
+    """Returns buffers into the mapping for a list of (position, size) pairs, in the same order."""
+    return [self.read(position, size) for position, size in ranges]
+
+  def flush(self):
+    """Does nothing, since writes to the mapping need no buffering in userspace; the host writes
+    the modified pages back on its own or when the device is synced."""
+    assert self.isMounted, "Device not mounted."
+
+  def sync(self):
+    """Flushes modified pages of the mapping to the image file."""
+    assert self.isMounted, "Device not mounted."
+    self._map.flush()
+    self._numSyscalls += 1
+
+
+
+
+class _DeviceFromMemory(_Device):
+  """Represents a device whose contents are held in memory. An image file can be loaded into it
+  and the contents saved back to an image file, each with a single read or write."""
+
+  @property
+  def isMounted(self):
+    """Returns whether the device is currently mounted."""
+    return self._isMounted
+
+  @property
+  def size(self):
+    """Gets the size of the device in bytes."""
+    return len(self._data)
+
+  @classmethod
+  def makeNew(cls, numBytes):
+    """Creates a new zero-filled device of the specified size."""
+    return cls(bytearray(numBytes))
+
+  @classmethod
+  def fromImageFile(cls, imageFilename):
+    """Creates a new device holding the contents of the specified image file."""
+    f = open(imageFilename, "rb")
+    with f:
+      f.seek(0, 2)
+      data = bytearray(f.tell())
+      f.seek(0)
+      if f.readinto(data) < len(data):
+        raise FilesystemError("Image file could not be read.")
+    return cls(data)
+
+  def __init__(self, data):
+    """Constructs a new device object over the specified bytearray."""
+    self._data = data
+    self._isMounted = False
+    self._zeroBuffer = ""
+
+  def mount(self):
+    """Opens reading/writing from/to the device."""
+    self._isMounted = True
+
+  def unmount(self):
+    """Closes reading/writing from/to the device. The contents are kept."""
+    self._isMounted = False
+
+  def save(self, imageFilename):
+    """Writes the contents of the device to the specified image file."""
+    f = open(imageFilename, "wb")
+    with f:
+      f.write(self._data)
+
+  def read(self, position, size):
+    """Returns a buffer of the specified size into the device memory at the specified position. The
+    buffer reflects later writes."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= len(self._data), "Requested bytes out of range."
+    return buffer(self._data, position, size)
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position."""
+    assert self.isMounted, "Device not mounted."
+    assert position+len(byteString) <= len(self._data),\
+      "Invalid device position [device size: {0} bytes].".format(len(self._data))
+    self._data[position:position+len(byteString)] = byteString
+
+  def readMany(self, ranges):
+    """Returns buffers into the device memory for a list of (position, size) pairs, in the same order."""
+    return [self.read(position, size) for position, size in ranges]
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros."""
+    self.write(position, buffer(self._getZeros(size), 0, size))
+
+  def discard(self, position, size):
+    """Does nothing, since memory that is no longer in use cannot be given back per block."""
+    assert self.isMounted, "Device not mounted."
+
+  def flush(self):
+    """Does nothing, since writes are applied to memory immediately."""
+    assert self.isMounted, "Device not mounted."
+
+
+
+
+class _DeviceFromOverlay(_Device):
+  """Represents a device that reads from a base image file without modifying it and sends all
+  writes to a sparse delta file. The delta file holds each modified block at its offset in the
+  image, followed by a bitmap of the blocks it holds, so that many sessions can share one base
+  image and reopen their own changes later. The changed bytes of the bitmap are written after the
+  blocks on every flush."""
+
+  @property
+  def isMounted(self):
+    """Returns whether the device is currently mounted."""
+    return (not self._baseFile is None)
+
+  @property
+  def size(self):
+    """Gets the size of the device in bytes."""
+    return self._imageSize
+
+  @property
+  def numModifiedBlocks(self):
+    """Gets the number of blocks held in the delta file."""
+    return sum([bin(byte).count("1") for byte in self._map])
+
+  def __init__(self, baseFilename, deltaFilename, blockSize = 4096):
+    """Constructs a new overlay device over the specified base image file and delta file. The
+    delta file is created when the device is first mounted if it does not exist."""
+    self._baseFilename = baseFilename
+    self._deltaFilename = deltaFilename
+    self._blockSize = blockSize
+    self._baseFile = None
+    self._deltaFile = None
+    self._map = bytearray()
+    self._changedMap = None
+    self._zeroBuffer = ""
+
+  def mount(self):
+    """Opens the base image for reading and the delta file for reading/writing."""
+    self._baseFile = open(self._baseFilename, "rb")
+    try:
+      self._baseFile.seek(0, 2)
+      self._imageSize = self._baseFile.tell()
+      numBlocks = (self._imageSize + self._blockSize - 1) / self._blockSize
+      mapSize = (numBlocks + 7) / 8
+
+      if not path.exists(self._deltaFilename):
+        f = open(self._deltaFilename, "wb")
+        with f:
+          f.truncate(self._imageSize + mapSize)
+      self._deltaFile = open(self._deltaFilename, "r+b")
+      self._deltaFile.seek(0, 2)
+      if self._deltaFile.tell() != self._imageSize + mapSize:
+        raise FilesystemError("Delta file does not match the base image.")
+      self._deltaFile.seek(self._imageSize)
+      self._map = bytearray(self._deltaFile.read(mapSize))
+      self._changedMap = None
+    except:
+      self._baseFile.close()
+      self._baseFile = None
+      if self._deltaFile:
+        self._deltaFile.close()
+        self._deltaFile = None
+      raise
+
+  def unmount(self):
+    """Saves the block map to the delta file and closes both files."""
+    if self._deltaFile:
+      self.flush()
+      fsync(self._deltaFile.fileno())
+      self._deltaFile.close()
+      self._numSyscalls += 2
+    if self._baseFile:
+      self._baseFile.close()
+    self._deltaFile = None
+    self._baseFile = None
+
+  def read(self, position, size):
+    """Reads a byte string of the specified size from the specified position, taking each run of
+    blocks from the delta file if it holds them or from the base image otherwise."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= self._imageSize, "Requested bytes out of range."
+    chunks = []
+    end = position + size
+    while position < end:
+      inDelta = self.__holdsBlock(position / self._blockSize)
+      runEnd = min(end, (position / self._blockSize + 1) * self._blockSize)
+      while runEnd < end and self.__holdsBlock(runEnd / self._blockSize) == inDelta:
+        runEnd = min(end, runEnd + self._blockSize)
+      f = self._deltaFile if inDelta else self._baseFile
+      f.seek(position)
+      chunks.append(f.read(runEnd - position))
+      self._numSyscalls += 2
+      position = runEnd
+    if len(chunks) == 1:
+      return chunks[0]
+    return "".join(chunks)
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position in the delta file. Blocks
+    that are only partly written are first copied from the base image."""
+    assert self.isMounted, "Device not mounted."
+    assert position+len(byteString) <= self._imageSize,\
+      "Invalid device position [device size: {0} bytes].".format(self._imageSize)
+    end = position + len(byteString)
+    for bid in range(position / self._blockSize, (end - 1) / self._blockSize + 1):
+      if self.__holdsBlock(bid):
+        continue
+      blockStart = bid * self._blockSize
+      blockEnd = min(blockStart + self._blockSize, self._imageSize)
+      if position > blockStart or end < blockEnd:
+        self._baseFile.seek(blockStart)
+        blockBytes = self._baseFile.read(blockEnd - blockStart)
+        self._deltaFile.seek(blockStart)
+        self._deltaFile.write(blockBytes)
+        self._numSyscalls += 4
+      self._map[bid / 8] |= (1 << (bid % 8))
+      self.__changeMap(bid / 8)
+    self._deltaFile.seek(position)
+    self._deltaFile.write(byteString)
+    self._numSyscalls += 2
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros."""
+    self.write(position, buffer(self._getZeros(size), 0, size))
+
+  def discard(self, position, size):
+    """Does nothing, since the base image is never modified."""
+    assert self.isMounted, "Device not mounted."
+
+  def flush(self):
+    """Flushes any buffered writes to the delta file, then writes the bytes of the block map that
+    have changed since the last flush, so that the blocks are on the device before the map refers
+    to them."""
+    assert self.isMounted, "Device not mounted."
+    self._deltaFile.flush()
+    self._numSyscalls += 1
+    if self._changedMap:
+      start, end = self._changedMap
+      self._changedMap = None
+      self._deltaFile.seek(self._imageSize + start)
+      self._deltaFile.write(self._map[start:end])
+      self._deltaFile.flush()
+      self._numSyscalls += 3
+
+  def commitDelta(self):
+    """Writes the blocks held in the delta file to the base image file and empties the delta file."""
+    wasMounted = self.isMounted
+    if not wasMounted:
+      self.mount()
+    try:
+      baseFile = open(self._baseFilename, "r+b")
+      with baseFile:
+        numBlocks = len(self._map) * 8
+        bid = 0
+        while bid < numBlocks:
+          if not self.__holdsBlock(bid):
+            bid += 1
+            continue
+          runStart = bid
+          while bid < numBlocks and self.__holdsBlock(bid):
+            bid += 1
+          start = runStart * self._blockSize
+          runSize = min(bid * self._blockSize, self._imageSize) - start
+          self._deltaFile.seek(start)
+          baseFile.seek(start)
+          baseFile.write(self._deltaFile.read(runSize))
+        baseFile.flush()
+        fsync(baseFile.fileno())
+      self.__clearDelta()
+    finally:
+      if not wasMounted:
+        self.unmount()
+
+  def discardDelta(self):
+    """Empties the delta file, throwing away all changes made on top of the base image."""
+    wasMounted = self.isMounted
+    if not wasMounted:
+      self.mount()
+    try:
+      self.__clearDelta()
+    finally:
+      if not wasMounted:
+        self.unmount()
+
+  def __clearDelta(self):
+    """Truncates the delta file so that it holds no blocks and clears the block map."""
+    self._deltaFile.flush()
+    self._deltaFile.truncate(0)
+    self._deltaFile.truncate(self._imageSize + len(self._map))
+    self._map = bytearray(len(self._map))
+    self._changedMap = None
+
+  def __changeMap(self, index):
+    """Widens the range of block map bytes that have changed since the last flush to include the
+    byte at the specified index."""
+    if self._changedMap is None:
+      self._changedMap = (index, index + 1)
+    else:
+      self._changedMap = (min(self._changedMap[0], index), max(self._changedMap[1], index + 1))
+
+  def __holdsBlock(self, bid):
+    """Returns whether the delta file holds the specified block."""
+    return (self._map[bid / 8] & (1 << (bid % 8))) != 0
+
+
+
+
+
+class _DeviceFromCompressedFile(_Device):
+  """Represents a device from a compressed image container. The image is split into fixed-size
+  chunks that are compressed independently with zlib or lzma, and an index of chunk locations
+  allows any chunk to be read without decompressing the others. Recently used chunks are kept
+  decompressed in memory. Modified chunks are recompressed when they are flushed or evicted and
+  written to the first gap left by earlier chunk versions that they fit in, or appended to the
+  container, and chunks holding only zeros are not stored at all. The space of a chunk's previous
+  version is only reused once the index no longer refers to it, so the container on disk stays
+  readable up to its last flush, and free space at the end of the container is truncated.
+
+  The container starts with a 32 byte header (magic number, compression type, chunk size, image
+  size and number of chunks), followed by the index, which holds the offset and compressed length
+  of each chunk, followed by the compressed chunks."""
+
+  MAGIC = "PYEXT2CZ"
+  DEFAULT_CHUNK_SIZE = 65536
+  DEFAULT_CACHE_SIZE = 64
+  _headerFormat = "<8sB3xIQI4x"
+  _indexEntryFormat = "<QI"
+  _compressionTypes = ["zlib", "lzma"]
+
+  @property
+  def isMounted(self):
+    """Returns whether the device is currently mounted."""
+    return (not self._imageFile is None)
+
+  @property
+  def size(self):
+    """Gets the size of the uncompressed image in bytes."""
+    return self._imageSize
+
+  @classmethod
+  def compressImage(cls, rawFilename, containerFilename, chunkSize = DEFAULT_CHUNK_SIZE, compression = "zlib"):
+    """Creates a compressed image container from the specified raw image file."""
+    if path.exists(containerFilename):
+      raise FilesystemError("Specified image file already exists.")
+    compress = cls.__getCompressor(compression)[0]
+
+    rawFile = open(rawFilename, "rb")
+    with rawFile:
+      rawFile.seek(0, 2)
+      imageSize = rawFile.tell()
+      rawFile.seek(0)
+      numChunks = (imageSize + chunkSize - 1) / chunkSize
+      index = []
+
+      containerFile = open(containerFilename, "wb")
+      with containerFile:
+        containerFile.write(pack(cls._headerFormat, cls.MAGIC, cls._compressionTypes.index(compression),
+                                 chunkSize, imageSize, numChunks))
+        containerFile.write("\0" * (numChunks * 12))
+        for i in range(numChunks):
+          chunk = rawFile.read(chunkSize)
+          if chunk.count("\0") == len(chunk):
+            index.append((0, 0))
+            continue
+          compressed = compress(chunk)
+          index.append((containerFile.tell(), len(compressed)))
+          containerFile.write(compressed)
+        containerFile.seek(32)
+        containerFile.write("".join([pack(cls._indexEntryFormat, *entry) for entry in index]))
+
+  @classmethod
+  def decompressImage(cls, containerFilename, rawFilename):
+    """Creates a raw image file from the specified compressed image container. Chunks holding only
+    zeros are left as holes in the raw image."""
+    if path.exists(rawFilename):
+      raise FilesystemError("Specified image file already exists.")
+    device = cls(containerFilename, 1)
+    device.mount()
+    try:
+      rawFile = open(rawFilename, "wb")
+      with rawFile:
+        for i in range(len(device._index)):
+          if device._index[i][1] == 0:
+            continue
+          rawFile.seek(i * device._chunkSize)
+          rawFile.write(device._decompress(device.__readCompressedChunk(i)))
+        rawFile.truncate(device._imageSize)
+    finally:
+      device.unmount()
+
+  @classmethod
+  def __getCompressor(cls, compression):
+    """Returns the (compress, decompress) functions for the specified compression type."""
+    if compression == "zlib":
+      return (zlib.compress, zlib.decompress)
+    if compression == "lzma":
+      if lzma is None:
+        raise UnsupportedOperationError("lzma compression requires the lzma module.")
+      return (lzma.compress, lzma.decompress)
+    raise FilesystemError("Invalid compression type specified.")
+
+  def __init__(self, filename, maxChunks = DEFAULT_CACHE_SIZE):
+    """Constructs a new device object from the specified container file, keeping up to maxChunks
+    decompressed chunks in memory."""
+    self._imageFilename = filename
+    self._imageFile = None
+    self._maxChunks = maxChunks
+    self._chunks = OrderedDict()
+    self._dirty = set()
+    self._gaps = []
+    self._slotsReleased = False
+    self._zeroBuffer = ""
+
+  def mount(self):
+    """Opens the container for reading/writing and reads its chunk index."""
+    self._imageFile = open(self._imageFilename, "r+b")
+    try:
+      header = self._imageFile.read(32)
+      if len(header) < 32:
+        raise FilesystemError("Invalid compressed image.")
+      magic, compressionType, self._chunkSize, self._imageSize, numChunks = unpack(self._headerFormat, header)
+      if magic != self.MAGIC or compressionType >= len(self._compressionTypes):
+        raise FilesystemError("Invalid compressed image.")
+      self._compress, self._decompress = self.__getCompressor(self._compressionTypes[compressionType])
+      indexBytes = self._imageFile.read(numChunks * 12)
+      if len(indexBytes) < numChunks * 12:
+        raise FilesystemError("Invalid compressed image.")
+      self._index = [unpack_from(self._indexEntryFormat, indexBytes, i * 12) for i in range(numChunks)]
+      self._imageFile.seek(0, 2)
+      self._fileSize = self._imageFile.tell()
+      self.__findGaps()
+    except:
+      self._imageFile.close()
+      self._imageFile = None
+      raise
+
+  def unmount(self):
+    """Writes modified chunks and the index to the container and closes it."""
+    if self._imageFile:
+      try:
+        self.flush()
+        fsync(self._imageFile.fileno())
+        self._numSyscalls += 1
+      finally:
+        self._imageFile.close()
+    self._imageFile = None
+    self._chunks.clear()
+    self._dirty.clear()
+    self._gaps = []
+    self._slotsReleased = False
+
+  def read(self, position, size):
+    """Reads a byte string of the specified size from the specified position."""
+    assert self.isMounted, "Device not mounted."
+    assert position+size <= self._imageSize, "Requested bytes out of range."
+    chunks = []
+    end = position + size
+    while position < end:
+      chunkNum = position / self._chunkSize
+      chunkStart = chunkNum * self._chunkSize
+      stop = min(end, chunkStart + self._chunkSize)
+      chunks.append(str(self.__getChunk(chunkNum)[position-chunkStart:stop-chunkStart]))
+      position = stop
+    if len(chunks) == 1:
+      return chunks[0]
+    return "".join(chunks)
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position. The modified chunks are
+    compressed when they are flushed or evicted."""
+    assert self.isMounted, "Device not mounted."
+    assert position+len(byteString) <= self._imageSize,\
+      "Invalid device position [device size: {0} bytes].".format(self._imageSize)
+    end = position + len(byteString)
+    offset = position
+    while offset < end:
+      chunkNum = offset / self._chunkSize
+      chunkStart = chunkNum * self._chunkSize
+      stop = min(end, chunkStart + self._chunkSize)
+      chunk = self.__getChunk(chunkNum)
+      chunk[offset-chunkStart:stop-chunkStart] = byteString[offset-position:stop-position]
+      self._dirty.add(chunkNum)
+      offset = stop
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros."""
+    self.write(position, buffer(self._getZeros(size), 0, size))
+
+  def discard(self, position, size):
+    """Marks the chunks that lie entirely within the specified range as holding only zeros."""
+    assert self.isMounted, "Device not mounted."
+    firstChunk = (position + self._chunkSize - 1) / self._chunkSize
+    for chunkNum in range(firstChunk, (position + size) / self._chunkSize):
+      self._chunks.pop(chunkNum, None)
+      self._dirty.discard(chunkNum)
+      self._slotsReleased = True
+      self._index[chunkNum] = (0, 0)
+
+  def flush(self):
+    """Compresses and writes all modified chunks, then writes the index. The space of the chunk
+    versions that the index no longer refers to is then free to be reused, and any free space at
+    the end of the container is truncated."""
+    assert self.isMounted, "Device not mounted."
+    for chunkNum in sorted(self._dirty):
+      self.__writeChunk(chunkNum, self._chunks[chunkNum])
+    self._dirty.clear()
+    self._imageFile.seek(32)
+    self._imageFile.write("".join([pack(self._indexEntryFormat, *entry) for entry in self._index]))
+    self._imageFile.flush()
+    self._numSyscalls += 3
+    if self._slotsReleased:
+      self._slotsReleased = False
+      self.__findGaps()
+    if self._dataEnd < self._fileSize:
+      self._imageFile.truncate(self._dataEnd)
+      self._fileSize = self._dataEnd
+      self._numSyscalls += 1
+
+  def __getChunk(self, chunkNum):
+    """Returns the decompressed bytes of the specified chunk, decompressing it if it is not cached
+    and evicting the least recently used chunk."""
+    chunk = self._chunks.pop(chunkNum, None)
+    if chunk is None:
+      chunkLength = min(self._chunkSize, self._imageSize - chunkNum * self._chunkSize)
+      if self._index[chunkNum][1] == 0:
+        chunk = bytearray(chunkLength)
+      else:
+        chunk = bytearray(self._decompress(self.__readCompressedChunk(chunkNum)))
+        if len(chunk) != chunkLength:
+          raise FilesystemError("Invalid compressed chunk.")
+      if len(self._chunks) >= self._maxChunks:
+        evictedNum, evictedChunk = self._chunks.popitem(last = False)
+        if evictedNum in self._dirty:
+          self.__writeChunk(evictedNum, evictedChunk)
+          self._dirty.remove(evictedNum)
+    self._chunks[chunkNum] = chunk
+    return chunk
+
+  def __readCompressedChunk(self, chunkNum):
+    """Reads and returns the compressed bytes of the specified chunk."""
+    offset, length = self._index[chunkNum]
+    self._imageFile.seek(offset)
+    self._numSyscalls += 2
+    return self._imageFile.read(length)
+
+  def __writeChunk(self, chunkNum, chunk):
+    """Compresses the specified chunk and writes it to the first gap it fits in, or appends it to
+    the container, updating the index. The space of the chunk's previous version is released."""
+    self._slotsReleased = True
+    if chunk.count("\0") == len(chunk):
+      self._index[chunkNum] = (0, 0)
+      return
+    compressed = self._compress(str(chunk))
+    offset = self.__takeSlot(len(compressed))
+    self._imageFile.seek(offset)
+    self._index[chunkNum] = (offset, len(compressed))
+    self._imageFile.write(compressed)
+    self._fileSize = max(self._fileSize, offset + len(compressed))
+    self._numSyscalls += 2
+
+  def __takeSlot(self, length):
+    """Returns the offset of the first gap that the specified number of bytes fit in, or of the end
+    of the stored chunks, and marks the space as used."""
+    for i, (offset, gapLength) in enumerate(self._gaps):
+      if gapLength >= length:
+        if gapLength > length:
+          self._gaps[i] = (offset + length, gapLength - length)
+        else:
+          del self._gaps[i]
+        return offset
+    offset = self._dataEnd
+    self._dataEnd += length
+    return offset
+
+  def __findGaps(self):
+    """Finds the gaps between the compressed chunks that the index refers to, and the end of the
+    last of them, from the index alone."""
+    offset = 32 + len(self._index) * 12
+    self._gaps = []
+    for start, length in sorted([entry for entry in self._index if entry[1] > 0]):
+      if start > offset:
+        self._gaps.append((offset, start - offset))
+      offset = max(offset, start + length)
+    self._dataEnd = offset
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Defines the in-memory index of free block extents used by the ext2 module.
+"""
+__license__ = "BSD"
+__copyright__ = "Copyright 2013, Michael R. Falcone"
+
+
+import re
+from array import array
+from bisect import bisect_right
+from .bgdt import _GroupIndex
+
+
+_bitStrings = ["".join([str((byte >> i) & 1) for i in range(8)]) for byte in range(256)]
+_freeRun = re.compile("0+")
+
+
+class _GroupExtents(object):
+  """Holds the free extents of one block group as a sorted list of start block ids and a parallel
+  list of lengths. Once an extent has to be searched for by length, a _GroupIndex of the extent
+  lengths by block offset in the group is built, so that the first extent long enough after a goal
+  and the largest extent are found in O(log blocks). For internal use only."""
+
+  @property
+  def numFreeBlocks(self):
+    """Gets the number of free blocks in the group."""
+    return self._numFree
+
+  @property
+  def numExtents(self):
+    """Gets the number of free extents in the group."""
+    return len(self._starts)
+
+  @property
+  def largest(self):
+    """Gets the length of the largest free extent in the group."""
+    return self._largest
+
+
+  def __init__(self, groupStart, numBlocks, starts, lengths):
+    """Constructs the free extents of the group of numBlocks blocks starting at the specified block
+    id from sorted lists of start block ids and lengths."""
+    self._groupStart = groupStart
+    self._numBlocks = numBlocks
+    self._starts = starts
+    self._lengths = lengths
+    self._lengthIndex = None
+    self._numFree = sum(lengths)
+    self._largest = max(lengths) if len(lengths) > 0 else 0
+
+
+  def first(self):
+    """Returns the first free block id in the group, or None if the group is full."""
+    if len(self._starts) == 0:
+      return None
+    return self._starts[0]
+
+
+  def find(self, count, goal):
+    """Returns the first block id at or after goal that starts count free blocks, or None."""
+    starts = self._starts
+    lengths = self._lengths
+    i = bisect_right(starts, goal) - 1
+    if i >= 0 and starts[i] + lengths[i] - goal >= count:
+      return goal
+    if self._largest < count:
+      return None
+    offset = self.__getLengthIndex().findFirst(goal - self._groupStart + 1, count)
+    if offset is None:
+      return None
+    return self._groupStart + offset
+
+
+  def extentAt(self, bid):
+    """Returns the (start, length) of the free extent holding the specified block id, or None if the
+    block is not free."""
+    i = bisect_right(self._starts, bid) - 1
+    if i >= 0 and bid < self._starts[i] + self._lengths[i]:
+      return (self._starts[i], self._lengths[i])
+    return None
+
+
+  def remove(self, bid, count):
+    """Marks count blocks starting at the specified block id as used. They must all be free."""
+    starts = self._starts
+    lengths = self._lengths
+    i = bisect_right(starts, bid) - 1
+    assert i >= 0 and bid + count <= starts[i] + lengths[i], "Blocks are not free."
+    start = starts[i]
+    length = lengths[i]
+    before = bid - start
+    after = start + length - (bid + count)
+    if before > 0:
+      lengths[i] = before
+      if after > 0:
+        starts.insert(i + 1, bid + count)
+        lengths.insert(i + 1, after)
+    elif after > 0:
+      starts[i] = bid + count
+      lengths[i] = after
+    else:
+      del starts[i]
+      del lengths[i]
+    self._numFree -= count
+    
+    index = self._lengthIndex
+    if index is None and length == self._largest:
+      index = self.__getLengthIndex()
+    elif not index is None:
+      index[start - self._groupStart] = before
+      if after > 0:
+        index[bid + count - self._groupStart] = after
+    if not index is None:
+      self._largest = index.maximum
+
+
+  def add(self, bid, count):
+    """Marks count blocks starting at the specified block id as free, merging them with the
+    neighbouring extents. They must all be used."""
+    starts = self._starts
+    lengths = self._lengths
+    i = bisect_right(starts, bid)
+    assert i == 0 or starts[i-1] + lengths[i-1] <= bid, "Blocks are already free."
+    assert i == len(starts) or bid + count <= starts[i], "Blocks are already free."
+    mergePrev = (i > 0 and starts[i-1] + lengths[i-1] == bid)
+    mergeNext = (i < len(starts) and starts[i] == bid + count)
+    if mergePrev and mergeNext:
+      lengths[i-1] += count + lengths[i]
+      del starts[i]
+      del lengths[i]
+      newLength = lengths[i-1]
+    elif mergePrev:
+      lengths[i-1] += count
+      newLength = lengths[i-1]
+    elif mergeNext:
+      starts[i] = bid
+      lengths[i] += count
+      newLength = lengths[i]
+    else:
+      starts.insert(i, bid)
+      lengths.insert(i, count)
+      newLength = count
+    self._numFree += count
+    self._largest = max(self._largest, newLength)
+    
+    index = self._lengthIndex
+    if not index is None:
+      if mergePrev:
+        index[starts[i-1] - self._groupStart] = newLength
+      else:
+        index[bid - self._groupStart] = newLength
+      if mergeNext:
+        index[bid + count - self._groupStart] = 0
+
+
+  def __getLengthIndex(self):
+    """Returns the index of extent lengths by block offset in the group, building it from the
+    extent lists the first time it is needed."""
+    if self._lengthIndex is None:
+      typecode = "H" if self._numBlocks <= 0xFFFF else "l"
+      values = array(typecode, [0]) * self._numBlocks
+      for start, length in zip(self._starts, self._lengths):
+        values[start - self._groupStart] = length
+      self._lengthIndex = _GroupIndex(values, typecode)
+    return self._lengthIndex
+
+
+
+
+class _FreeExtentIndex(object):
+  """Indexes the free extents of every block group, so that the first free block of a group or a
+  run of free blocks near a goal block can be found without scanning bitmaps. The largest extent
+  of each group is kept in a _GroupIndex, and the total numbers of free blocks and extents are kept
+  as running counts. For internal use only."""
+
+  @property
+  def numFreeBlocks(self):
+    """Gets the total number of free blocks."""
+    return self._numFree
+
+  @property
+  def numFreeExtents(self):
+    """Gets the total number of free extents."""
+    return self._numExtents
+
+  @property
+  def largestFreeExtent(self):
+    """Gets the length of the largest free extent."""
+    return self._largest.maximum
+
+
+  def __init__(self, superblock, bitmaps):
+    """Builds the index from the specified list of block bitmaps, one byte string per group. Bits
+    past the last block of a group are ignored."""
+    self._firstBlockId = superblock.firstDataBlockId
+    self._numBlocksPerGroup = superblock.numBlocksPerGroup
+    self._groups = []
+    for groupNum, bitmap in enumerate(bitmaps):
+      groupStart = groupNum * self._numBlocksPerGroup + self._firstBlockId
+      numBlocks = min(self._numBlocksPerGroup, superblock.numBlocks - groupStart)
+      byteString = str(bitmap[:(numBlocks + 7) / 8])
+      bits = "".join([_bitStrings[byte] for byte in bytearray(byteString)])[:numBlocks]
+      starts = []
+      lengths = []
+      for run in _freeRun.finditer(bits):
+        starts.append(groupStart + run.start())
+        lengths.append(run.end() - run.start())
+      self._groups.append(_GroupExtents(groupStart, numBlocks, starts, lengths))
+    self._largest = _GroupIndex([group.largest for group in self._groups])
+    self._numFree = sum([group.numFreeBlocks for group in self._groups])
+    self._numExtents = sum([group.numExtents for group in self._groups])
+
+
+  def groupOf(self, bid):
+    """Returns the number of the block group holding the specified block id."""
+    return (bid - self._firstBlockId) / self._numBlocksPerGroup
+
+
+  def firstFree(self, groupNum):
+    """Returns the first free block id in the specified group, or None if the group is full."""
+    return self._groups[groupNum].first()
+
+
+  def extentAt(self, bid):
+    """Returns the (start, length) of the free extent holding the specified block id, or None if the
+    block is not free."""
+    return self._groups[self.groupOf(bid)].extentAt(bid)
+
+
+  def find(self, count, goal = None):
+    """Returns the first block id at or after goal that starts count free blocks within one group,
+    wrapping around to the start of the filesystem, or None if there is no such run."""
+    if goal is None:
+      goal = self._firstBlockId
+    goalGroup = min(self.groupOf(goal), len(self._groups) - 1)
+    if self._largest[goalGroup] >= count:
+      bid = self._groups[goalGroup].find(count, goal)
+      if not bid is None:
+        return bid
+    groupNum = self._largest.findFirst(goalGroup + 1, count)
+    if groupNum is None:
+      groupNum = self._largest.findFirst(0, count)
+    if groupNum is None:
+      return None
+    groupStart = groupNum * self._numBlocksPerGroup + self._firstBlockId
+    return self._groups[groupNum].find(count, groupStart)
+
+
+  def allocate(self, bid, count = 1):
+    """Removes count free blocks starting at the specified block id from the index."""
+    groupNum = self.groupOf(bid)
+    group = self._groups[groupNum]
+    numExtents = group.numExtents
+    group.remove(bid, count)
+    self._numFree -= count
+    self._numExtents += group.numExtents - numExtents
+    if self._largest[groupNum] != group.largest:
+      self._largest[groupNum] = group.largest
+
+
+  def free(self, bid, count = 1):
+    """Adds count blocks starting at the specified block id to the index as free."""
+    groupNum = self.groupOf(bid)
+    group = self._groups[groupNum]
+    numExtents = group.numExtents
+    group.add(bid, count)
+    self._numFree += count
+    self._numExtents += group.numExtents - numExtents
+    if self._largest[groupNum] != group.largest:
+      self._largest[groupNum] = group.largest
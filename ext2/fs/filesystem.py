@@ -7,6 +7,7 @@ __copyright__ = "Copyright 2013, Michael R. Falcone"
 
 
 import inspect
+from threading import Thread, Event
 from uuid import uuid4
 from os import path, remove
 from collections import deque
@@ -14,11 +15,17 @@ from struct import pack, unpack
 from time import time
 from math import ceil
 from ..file.directory import _openRootDirectory
-from ..error import FilesystemError
+from ..error import FilesystemError, UnsupportedOperationError
 from .superblock import _Superblock
 from .bgdt import _BGDT
 from .inode import _Inode
-from .device import _DeviceFromFile
+from .device import _DeviceFromFile, _DeviceFromMappedFile, _DeviceFromMemory, _DeviceFromOverlay, \
+                    _DeviceFromCompressedFile
+from .cache import _BlockCache
+from .inodecache import _InodeCache
+from .extents import _FreeExtentIndex
+from .bitmap import _Bitmap
+from .iostats import _IOStats, _InstrumentedDevice, _TaggedDevice
 
 
 class InformationReport(object):
@@ -28,6 +35,7 @@ class InformationReport(object):
 
 class Ext2Filesystem(object):
   """Models a filesystem image file formatted to Ext2."""
+  DEFAULT_PREALLOCATE_BLOCKS = 8
   
   
   @property
@@ -116,20 +124,43 @@ class Ext2Filesystem(object):
     if blockSize != 1024 and blockSize != 2048 and blockSize != 4096:
       raise FilesystemError("Invalid blocksize specified.")
     device = _DeviceFromFile.makeNew(imageFilename, blockSize * numBlocks)
+    try:
+      cls._formatDevice(device, blockSize, numBlocks)
+    except Exception:
+      if path.exists(imageFilename):
+        remove(imageFilename)
+      raise
+
+    return cls(device)
+  
+  
+  
+  @classmethod
+  def makeInMemory(cls, blockSize, numBlocks):
+    """Creates a new Ext2 filesystem with the specified number of blocks that is held entirely
+    in memory. The specified block size must be either 1024, 2048, or 4096. The image can be
+    written to a file with saveImageFile()."""
+    if blockSize != 1024 and blockSize != 2048 and blockSize != 4096:
+      raise FilesystemError("Invalid blocksize specified.")
+    device = _DeviceFromMemory.makeNew(blockSize * numBlocks)
+    cls._formatDevice(device, blockSize, numBlocks)
+    return cls(device, 0)
+  
+  
+  
+  @classmethod
+  def _formatDevice(cls, device, blockSize, numBlocks):
+    """Writes a new Ext2 filesystem with the specified block size and number of blocks to the
+    specified unmounted device."""
     device.mount()
     try:
+      cache = _BlockCache(device, blockSize, writeBack = True)
       currentTime = int(time())
       volumeId = uuid4().bytes
       
-      # write superblocks and BGDTs
-      superblock = _Superblock.new(1024, device, 0, blockSize, numBlocks, currentTime, volumeId)
-      bgdt = _BGDT.new(0, superblock, device)
-      
-      if len(superblock.copyLocations) > 0:
-        for bgNum in superblock.copyLocations[1:]:
-          offset = (bgNum * superblock.numBlocksPerGroup + superblock.firstDataBlockId) * blockSize
-          shadowSb = _Superblock.new(offset, device, bgNum, blockSize, numBlocks, currentTime, volumeId)
-          _BGDT.new(bgNum, shadowSb, device)
+      # write primary superblock and BGDT; the shadow copies are written once formatting is done
+      superblock = _Superblock.new(1024, cache, 0, blockSize, numBlocks, currentTime, volumeId)
+      bgdt = _BGDT.new(0, superblock, cache)
 
 
       # write root directory
@@ -149,19 +180,20 @@ class Ext2Filesystem(object):
       mode |= 0x0001 # others execute
       rootInodeBytes = pack("<2HI4IH", mode, uid, 0, currentTime, currentTime, currentTime, 0, gid)
       rootInodeBytes = "{0}{1}".format(rootInodeBytes, "".join(map(pack, fillFmt, zeroFill)))
-      device.write(rootInodeOffset, rootInodeBytes)
+      cache.write(rootInodeOffset, rootInodeBytes)
       
-      superblock._saveCopies = True
       bgdt.entries[0].numInodesAsDirs += 1
       
       fs = cls(device)
+      fs._cache = cache
+      fs._bitmapDevice = _TaggedDevice(cache, fs._ioStats, "bitmap")
       fs._superblock = superblock
       fs._bgdt = bgdt
       fs._isValid = True
       
       rootBid = fs._allocateBlock(True)
       defaultEntries = pack("<IHBB1s3xIHBB2s", 2, 12, 1, 2, ".", 2, blockSize - 12, 2, 2, "..")
-      fs._writeToBlock(rootBid, 0, defaultEntries)
+      fs._writeToBlock(rootBid, 0, defaultEntries, "directory")
       
       rootInode = fs._readInode(2)
       rootInode.numLinks += 2
@@ -174,37 +206,107 @@ class Ext2Filesystem(object):
       while lfDir._inode.numDataBlocks < 8:
         newBid = fs._allocateBlock(True)
         lfDir._inode.assignNextBlockId(newBid)
-        fs._writeToBlock(newBid, 4, pack("<H", blockSize))
+        fs._writeToBlock(newBid, 4, pack("<H", blockSize), "directory")
         lfDir._inode.size += blockSize
 
-      device.unmount()
+      fs.__flushMetadata()
+      fs.syncBackups()
+      cache.flush()
+      fs._isValid = False
       
-    except Exception:
+    finally:
       if device.isMounted:
         device.unmount()
-      if path.exists(imageFilename):
-        remove(imageFilename)
-      raise
-
-    return cls(device)
     
   
   
   
   
   @classmethod
-  def fromImageFile(cls, imageFilename):
-    """Creates a new Ext2 filesystem from the specified image file."""
-    return cls(_DeviceFromFile(imageFilename))
+  def fromImageFile(cls, imageFilename, memoryMapped = False, cacheSize = None, durability = "write", discard = False,
+                    inMemory = False, backupPolicy = "sync", backupInterval = 60):
+    """Creates a new Ext2 filesystem from the specified image file. If memoryMapped is True,
+    the image is memory-mapped while mounted instead of being accessed with file reads and writes;
+    the mapping is only synced to the image file on sync() and unmount, whatever the durability.
+    If inMemory is True, the whole image is read into memory and changes are only written back
+    with saveImageFile(). The cache size is the maximum number of blocks kept in memory; by default
+    blocks are cached unless the image is memory-mapped or in memory. Under the "background" backup
+    policy, the shadow superblock and BGDT copies are rewritten on sync() and unmount, and at the end
+    of the first file or directory operation after each backupInterval seconds, so an idle
+    filesystem does not rewrite them until its next operation. See the constructor for the
+    durability, discard and backup options."""
+    if memoryMapped and inMemory:
+      raise FilesystemError("An image cannot be both memory-mapped and held in memory.")
+    if cacheSize is None:
+      cacheSize = 0 if memoryMapped or inMemory else _BlockCache.DEFAULT_SIZE
+    if inMemory:
+      device = _DeviceFromMemory.fromImageFile(imageFilename)
+    elif memoryMapped:
+      device = _DeviceFromMappedFile(imageFilename)
+    else:
+      device = _DeviceFromFile(imageFilename)
+    return cls(device, cacheSize, durability, discard, backupPolicy, backupInterval)
   
-  def __init__(self, device):
-    """Constructs a new Ext2 filesystem from the specified device object."""
+  @classmethod
+  def fromImageFileWithDelta(cls, imageFilename, deltaFilename, cacheSize = _BlockCache.DEFAULT_SIZE, durability = "write"):
+    """Creates a new Ext2 filesystem that reads from the specified image file without modifying it
+    and writes all changes to the specified delta file, which is created if it does not exist. The
+    changes can be applied to the image with commitDelta() or thrown away with discardDelta()."""
+    return cls(_DeviceFromOverlay(imageFilename, deltaFilename), cacheSize, durability)
+  
+  @classmethod
+  def fromCompressedImageFile(cls, imageFilename, cacheSize = 0, durability = "unmount",
+                              numCachedChunks = _DeviceFromCompressedFile.DEFAULT_CACHE_SIZE):
+    """Creates a new Ext2 filesystem from the specified compressed image container, which is read
+    without being inflated. Up to numCachedChunks decompressed chunks are kept in memory, so the
+    block cache is disabled by default. Every flush recompresses the modified chunks, so changes
+    are only written on sync() and unmount by default; see the constructor for the durability options."""
+    return cls(_DeviceFromCompressedFile(imageFilename, numCachedChunks), cacheSize, durability)
+  
+  @classmethod
+  def compressImageFile(cls, imageFilename, compressedFilename, chunkSize = _DeviceFromCompressedFile.DEFAULT_CHUNK_SIZE,
+                        compression = "zlib"):
+    """Creates a compressed image container from the specified raw image file, compressing it in
+    chunks of the specified size with zlib or lzma."""
+    _DeviceFromCompressedFile.compressImage(imageFilename, compressedFilename, chunkSize, compression)
+  
+  @classmethod
+  def decompressImageFile(cls, compressedFilename, imageFilename):
+    """Creates a raw image file from the specified compressed image container."""
+    _DeviceFromCompressedFile.decompressImage(compressedFilename, imageFilename)
+  
+  def __init__(self, device, cacheSize = _BlockCache.DEFAULT_SIZE, durability = "write", discard = False,
+               backupPolicy = "sync", backupInterval = 60):
+    """Constructs a new Ext2 filesystem from the specified device object with the specified block
+    cache size, durability policy ("write", "sync" or "unmount"), discarding of freed blocks and
+    backup policy ("none", "sync" or "background")."""
+    if not durability in ("write", "sync", "unmount"):
+      raise FilesystemError("Invalid durability policy.")
+    if not backupPolicy in ("none", "sync", "background"):
+      raise FilesystemError("Invalid backup policy.")
     self._device = device
+    self._ioStats = _IOStats()
+    self._ioDevice = _InstrumentedDevice(device, self._ioStats)
+    self._cacheSize = cacheSize
+    self._durability = durability
+    self._discard = discard
+    self._backupPolicy = backupPolicy
+    self._backupInterval = backupInterval
+    self._backupsStale = False
+    self._backupsDue = False
+    self._backupThread = None
+    self._freeExtents = None
+    self._blockBitmaps = {}
+    self._inodeBitmaps = {}
+    self._preallocations = {}
+    self._delayedFiles = {}
+    self._inodeCache = _InodeCache()
+    self._isModified = False
     self._isValid = False
   
   def __del__(self):
     """Destructor that unmounts the filesystem if it has not been unmounted."""
-    if self._device.isMounted:
+    if self._isValid and self._device.isMounted:
       self.unmount()
   
   def __enter__ (self):
@@ -223,10 +325,25 @@ class Ext2Filesystem(object):
     error if the root directory cannot be read."""
     self._device.mount()
     try:
-      self._superblock = _Superblock.read(1024, self._device)
-      self._bgdt = _BGDT.read(0, self._superblock, self._device)
+      self._ioStats.origin = "superblock"
+      blockSize = _Superblock.read(1024, self._ioDevice).blockSize
+      self._cache = _BlockCache(self._ioDevice, blockSize, self._cacheSize, self._durability != "write", self._ioStats)
+      self._superblock = _Superblock.read(1024, _TaggedDevice(self._cache, self._ioStats, "superblock"))
+      self._bgdt = _BGDT.read(0, self._superblock, _TaggedDevice(self._cache, self._ioStats, "bgdt"))
+      self._bitmapDevice = _TaggedDevice(self._cache, self._ioStats, "bitmap")
+      self._blockBitmaps = {}
+      self._inodeBitmaps = {}
+      self._preallocations = {}
+      self._delayedFiles = {}
+      self._inodeCache.clear()
+      self._freeExtents = None
       self._isValid = True
       _openRootDirectory(self)
+      if self._backupPolicy == "background":
+        self._stopBackups = Event()
+        self._backupThread = Thread(target = self.__scheduleBackups)
+        self._backupThread.daemon = True
+        self._backupThread.start()
     except:
       if self._device.isMounted:
         self._device.unmount()
@@ -239,15 +356,138 @@ class Ext2Filesystem(object):
   def unmount(self):
     """Unmounts the Ext2 filesystem so that reading and writing may no longer occur, and closes
     access to the device."""
+    if self._backupThread:
+      self._stopBackups.set()
+      self._backupThread.join()
+      self._backupThread = None
     if self._device.isMounted:
-      self._device.unmount()
+      try:
+        self._flushDelayedFiles()
+        self.__flushMetadata()
+        self._cache.flush()
+      finally:
+        self._cache.invalidate()
+        self._inodeCache.clear()
+        self._device.unmount()
     self._isValid = False
   
   
   
+  def saveImageFile(self, imageFilename):
+    """Writes the image of a filesystem held in memory to the specified image file with a single
+    write. Changes held in the block cache and data held for delayed allocation are included."""
+    if not isinstance(self._device, _DeviceFromMemory):
+      raise UnsupportedOperationError("Only a filesystem held in memory can be saved to an image file.")
+    if self._device.isMounted:
+      self._flushDelayedFiles()
+      self.__flushMetadata()
+      self._cache.flush()
+    self._device.save(imageFilename)
+  
+  
+  
+  def commitDelta(self):
+    """Writes the changes held in the delta file of a filesystem opened with fromImageFileWithDelta()
+    to its image file, and empties the delta file."""
+    if not isinstance(self._device, _DeviceFromOverlay):
+      raise UnsupportedOperationError("Filesystem was not opened with a delta file.")
+    if self._device.isMounted:
+      self._flushDelayedFiles()
+      self.__flushMetadata()
+      self._cache.flush()
+    self._device.commitDelta()
+  
+  
+  
+  def discardDelta(self):
+    """Throws away the changes held in the delta file of a filesystem opened with
+    fromImageFileWithDelta(). The filesystem must not be mounted."""
+    if not isinstance(self._device, _DeviceFromOverlay):
+      raise UnsupportedOperationError("Filesystem was not opened with a delta file.")
+    if self._device.isMounted:
+      raise FilesystemError("Filesystem must be unmounted to discard its changes.")
+    self._device.discardDelta()
+  
+  
+  
+  def sync(self):
+    """Writes the superblock and all dirty blocks to the device in block order and flushes it,
+    whatever the durability policy."""
+    assert self.isValid, "Filesystem is not valid."
+    self._flushDelayedFiles()
+    self.__flushMetadata()
+    self._cache.flush()
+  
+  
+  
+  def __writeInodes(self):
+    """Writes the dirty inodes to the block cache in inode table order."""
+    for inode in sorted(self._inodeCache.pinnedInodes, key = lambda inode: inode.number):
+      inode.write()
+  
+  
+  
+  def _endOperation(self):
+    """Writes the dirty inodes at the end of an operation on a file or directory if the durability
+    policy is "write", so that each changed inode is written once per operation. Under the other
+    policies they are held until sync() or unmount. If a background rewrite of the shadow copies is
+    due, it is done here, once the operation has left the counters consistent with the bitmaps."""
+    if self._durability == "write":
+      self.__writeInodes()
+    if self._backupsDue:
+      self.syncBackups()
+  
+  
+  
+  def __writeBitmaps(self):
+    """Writes the cached bitmaps that have changed to the block cache."""
+    for bitmap in self._blockBitmaps.values() + self._inodeBitmaps.values():
+      bitmap.write()
+  
+  
+  
+  def __flushMetadata(self):
+    """Writes the changed bitmaps, updates the time of last write if anything has been written since
+    the superblock was last flushed, then writes the superblock if it has changed. Dirty inodes are
+    written first."""
+    self.__writeInodes()
+    self.__writeBitmaps()
+    if self._isModified or self._superblock.isDirty:
+      self._superblock.timeLastWrite = int(time())
+      self._isModified = False
+      self._backupsStale = True
+    self._superblock.flush()
+    if self._backupsStale and self._backupPolicy != "none":
+      self.syncBackups()
+  
+  
+  
+  def syncBackups(self):
+    """Rewrites the shadow copies of the superblock and BGDT in every backup block group from the
+    primary copies, in one pass, after writing the primary superblock if it has changed so that the
+    copies are never newer than it. The writes reach the device according to the durability policy."""
+    assert self.isValid, "Filesystem is not valid."
+    self._backupsDue = False
+    self._backupsStale = False
+    self._superblock.flush()
+    self._superblock.writeCopies()
+    self._bgdt.writeCopies()
+  
+  
+  
+  def __scheduleBackups(self):
+    """Runs on the background thread, scheduling a rewrite of the shadow copies every backupInterval
+    seconds until the filesystem is unmounted. The rewrite itself is left to the end of the next
+    operation on the thread using the filesystem, since the block cache is not shared between threads."""
+    while not self._stopBackups.wait(self._backupInterval):
+      self._backupsDue = True
+  
+  
+  
   
   def scanBlockGroups(self):
-    """Scans all block groups and returns an information report about them."""
+    """Scans all block groups and returns an information report about them, including how many
+    regular files are split into more than one run of contiguous blocks."""
     assert self.isValid, "Filesystem is not valid."
     
     report = InformationReport()
@@ -256,6 +496,8 @@ class Ext2Filesystem(object):
     
     # count files and directories
     report.numRegFiles = 0
+    report.numFragmentedFiles = 0
+    report.numFileRuns = 0
     report.numSymlinks = 0
     report.numDirs = 1 # initialize with root directory
     q = deque([])
@@ -272,6 +514,10 @@ class Ext2Filesystem(object):
           q.append(f)
         elif f.isRegular:
           report.numRegFiles += 1
+          numRuns = len(f._inode.blockRuns())
+          report.numFileRuns += numRuns
+          if numRuns > 1:
+            report.numFragmentedFiles += 1
         elif f.isSymlink:
           report.numSymlinks += 1
     
@@ -296,6 +542,8 @@ class Ext2Filesystem(object):
     """Evaluates the integrity of the filesystem and returns an information report."""
     assert self.isValid, "Filesystem is not valid."
     
+    self._flushDelayedFiles()
+    
     report = InformationReport()
     checkPassed = True
     
@@ -313,9 +561,9 @@ class Ext2Filesystem(object):
       
       firstSbCopyStartPos = (self._superblock.copyLocations[1] * self._superblock.numBlocksPerGroup
                              + self._superblock.firstDataBlockId) * self._superblock.blockSize
-      firstSbCopy = _Superblock.read(firstSbCopyStartPos, self._device)
+      firstSbCopy = _Superblock.read(firstSbCopyStartPos, self._cache)
 
-      firstBgtCopy = _BGDT.read(self._superblock.copyLocations[1], firstSbCopy, self._device)
+      firstBgtCopy = _BGDT.read(self._superblock.copyLocations[1], firstSbCopy, self._cache)
 
       sbMembers = dict(inspect.getmembers(firstSbCopy))
       bgtMembersEntries = map(dict, map(inspect.getmembers, firstBgtCopy.entries))
@@ -327,14 +575,14 @@ class Ext2Filesystem(object):
         # evaluate superblock copy consistency
         try:
           startPos = (groupId * self._superblock.numBlocksPerGroup + self._superblock.firstDataBlockId) * self._superblock.blockSize
-          sbCopy = _Superblock.read(startPos, self._device)
+          sbCopy = _Superblock.read(startPos, self._cache)
           sbCopyMembers = dict(inspect.getmembers(sbCopy))
         except:
           report.messages.append("Superblock at block group {0} could not be read.".format(groupId))
           sbCopiesGood = False
           continue
         for m in sbMembers:
-          if m.startswith("_"):
+          if m.startswith("_") or inspect.ismethod(sbMembers[m]):
             continue
           if not m in sbCopyMembers:
             report.messages.append("Superblock at block group {0} has missing field '{1}'.".format(groupId, m))
@@ -345,7 +593,7 @@ class Ext2Filesystem(object):
         
         # evaluate block group descriptor table consistency
         try:
-          bgtCopy = _BGDT.read(groupId, self._superblock, self._device)
+          bgtCopy = _BGDT.read(groupId, self._superblock, self._cache)
           bgtCopyMembersEntries = map(dict, map(inspect.getmembers, bgtCopy.entries))
         except:
           report.messages.append("Block group descriptor table at block group {0} could not be read.".format(groupId))
@@ -380,6 +628,7 @@ class Ext2Filesystem(object):
     # validate inode and block references
     blocksGood = True
     inodesGood = True
+    self.__writeBitmaps()
     inodes = self.__getUsedInodes()
     inodesReachable = dict(zip(inodes, [False] * len(inodes)))
     blocks = self.__getUsedBlocks()
@@ -404,15 +653,16 @@ class Ext2Filesystem(object):
         
         # check block references
         if not f.isSymlink or f.size > 60:
+          filePath = f.absolutePath
           for bid in f._inode.usedBlocks():
             if not bid in blocksAccessedBy:
-              report.messages.append("The file {0} is referencing a block that is not marked as used by the filesystem (block id: {1})".format(f.absolutePath, bid))
+              report.messages.append("The file {0} is referencing a block that is not marked as used by the filesystem (block id: {1})".format(filePath, bid))
               blocksGood = False
             elif blocksAccessedBy[bid]:
-              report.messages.append("Block id {0} is being referenced by both {1} and {2}.".format(bid, blocksAccessedBy[bid], f.absolutePath))
+              report.messages.append("Block id {0} is being referenced by both {1} and {2}.".format(bid, blocksAccessedBy[bid], filePath))
               blocksGood = False
             else:
-              blocksAccessedBy[bid] = f.absolutePath
+              blocksAccessedBy[bid] = filePath
     
     
     for inodeNum in inodesReachable:
@@ -434,9 +684,15 @@ class Ext2Filesystem(object):
     totalFreeBlocks = 0
     totalFreeInodes = 0
     
+    bitmapBids = []
+    for entry in self._bgdt.entries:
+      bitmapBids.append(entry.blockBitmapLocation)
+      bitmapBids.append(entry.inodeBitmapLocation)
+    bitmapBlocks = self._readBlocks(bitmapBids, "bitmap")
+    
     for entryNum,entry in enumerate(self._bgdt.entries):
-      blockBitmap = unpack("{0}B".format(self._superblock.blockSize), self._readBlock(entry.blockBitmapLocation))
-      inodeBitmap = unpack("{0}B".format(self._superblock.blockSize), self._readBlock(entry.inodeBitmapLocation))
+      blockBitmap = unpack("{0}B".format(self._superblock.blockSize), bitmapBlocks[2 * entryNum])
+      inodeBitmap = unpack("{0}B".format(self._superblock.blockSize), bitmapBlocks[2 * entryNum + 1])
       usedBlockCount = 0
       usedInodeCount = 0
       dirCount = 0
@@ -500,15 +756,86 @@ class Ext2Filesystem(object):
   
   
   
+  def freeExtentStats(self):
+    """Returns an information report about the free space as extents of contiguous free blocks: the
+    number of free blocks, the number of free extents, and the length of the largest and the mean
+    length of the free extents, in blocks. Blocks reserved in preallocation windows are not counted
+    as free."""
+    assert self.isValid, "Filesystem is not valid."
+    
+    extents = self._getFreeExtents()
+    report = InformationReport()
+    report.numFreeBlocks = extents.numFreeBlocks
+    report.numFreeExtents = extents.numFreeExtents
+    report.largestFreeExtent = extents.largestFreeExtent
+    report.meanFreeExtent = 0
+    if report.numFreeExtents > 0:
+      report.meanFreeExtent = float(report.numFreeBlocks) / report.numFreeExtents
+    return report
+  
+  
+  
+  def cacheStats(self):
+    """Returns an information report about the block and inode caches, with their sizes and hit/miss
+    counts."""
+    assert self.isValid, "Filesystem is not valid."
+    
+    report = InformationReport()
+    report.numBlocks = self._cache.numBlocks
+    report.maxBlocks = self._cache.maxBlocks
+    report.numDirtyBlocks = self._cache.numDirtyBlocks
+    report.hits = self._cache.hits
+    report.misses = self._cache.misses
+    report.numInodes = self._inodeCache.numInodes
+    report.maxInodes = self._inodeCache.maxInodes
+    report.numPinnedInodes = self._inodeCache.numPinnedInodes
+    report.inodeHits = self._inodeCache.hits
+    report.inodeMisses = self._inodeCache.misses
+    return report
+  
+  
+  
+  def ioStats(self):
+    """Returns an information report about the I/O issued to the device since the filesystem was
+    created: totals and per-origin counts of reads, writes, bytes and host system calls, the numbers
+    of flushes and discards, and latency histograms as lists of (bucket, count) pairs. The origins
+    are superblock, bgdt, bitmap, inodeTable, directory, indirect and data."""
+    stats = self._ioStats
+    
+    report = InformationReport()
+    report.reads = sum(stats.reads.values())
+    report.writes = sum(stats.writes.values())
+    report.bytesRead = sum(stats.bytesRead.values())
+    report.bytesWritten = sum(stats.bytesWritten.values())
+    report.flushes = stats.flushes
+    report.discards = stats.discards
+    report.syscalls = sum(stats.syscalls.values()) + stats.flushSyscalls
+    report.origins = {}
+    for origin in stats.ORIGINS:
+      originReport = InformationReport()
+      originReport.reads = stats.reads[origin]
+      originReport.writes = stats.writes[origin]
+      originReport.bytesRead = stats.bytesRead[origin]
+      originReport.bytesWritten = stats.bytesWritten[origin]
+      originReport.syscalls = stats.syscalls[origin]
+      report.origins[origin] = originReport
+    labels = [label for limit, label in stats.LATENCY_BUCKETS]
+    report.readLatency = zip(labels, stats.readLatency)
+    report.writeLatency = zip(labels, stats.writeLatency)
+    report.flushLatency = zip(labels, stats.flushLatency)
+    return report
+  
+  
+  
   def __getUsedInodes(self):
     """Returns a list of all used inode numbers, excluding those reserved by the
     filesystem."""
     used = []
     bitmaps = []
-    for bgdtEntry in self._bgdt.entries:
-      bitmapStartPos = bgdtEntry.inodeBitmapLocation * self._superblock.blockSize
-      bitmapSize = self._superblock.numInodesPerGroup / 8
-      bitmapBytes = self._device.read(bitmapStartPos, bitmapSize)
+    bitmapSize = self._superblock.numInodesPerGroup / 8
+    bitmapRanges = [(e.inodeBitmapLocation * self._superblock.blockSize, bitmapSize) for e in self._bgdt.entries]
+    self._ioStats.origin = "bitmap"
+    for bitmapBytes in self._cache.readMany(bitmapRanges):
       if len(bitmapBytes) < bitmapSize:
         raise FilesystemError("Invalid inode bitmap.")
       bitmaps.append(unpack("{0}B".format(bitmapSize), bitmapBytes))
@@ -530,10 +857,10 @@ class Ext2Filesystem(object):
     """Returns a list off all block ids currently in use by the filesystem."""
     used = []
     bitmaps = []
-    for bgdtEntry in self._bgdt.entries:
-      bitmapStartPos = bgdtEntry.blockBitmapLocation * self._superblock.blockSize
-      bitmapSize = self._superblock.numBlocksPerGroup / 8
-      bitmapBytes = self._device.read(bitmapStartPos, bitmapSize)
+    bitmapSize = self._superblock.numBlocksPerGroup / 8
+    bitmapRanges = [(e.blockBitmapLocation * self._superblock.blockSize, bitmapSize) for e in self._bgdt.entries]
+    self._ioStats.origin = "bitmap"
+    for bitmapBytes in self._cache.readMany(bitmapRanges):
       if len(bitmapBytes) < bitmapSize:
         raise FilesystemError("Invalid block bitmap.")
       bitmaps.append(unpack("{0}B".format(bitmapSize), bitmapBytes))
@@ -551,89 +878,299 @@ class Ext2Filesystem(object):
   
   
   
-  def _readBlock(self, bid, offset = 0, count = None):
-    """Reads from the block specified by the given block id and returns a string of bytes."""
+  def _readBlock(self, bid, offset = 0, count = None, origin = "data"):
+    """Reads from the block specified by the given block id and returns a string of bytes. The
+    origin names the kind of structure being read, for the I/O statistics."""
     if not count:
       count = self._superblock.blockSize
-    block = self._device.read(bid * self._superblock.blockSize + offset, count)
+    self._ioStats.origin = origin
+    block = self._cache.read(bid * self._superblock.blockSize + offset, count)
     if len(block) < count:
       raise FilesystemError("Invalid block.")
     return block
 
 
 
+  def _readBlocks(self, bids, origin = "data"):
+    """Reads the blocks specified by the given list of block ids and returns a list of byte strings
+    in the same order. Blocks that are adjacent on the device are read together."""
+    blockSize = self._superblock.blockSize
+    self._ioStats.origin = origin
+    blocks = self._cache.readMany([(bid * blockSize, blockSize) for bid in bids])
+    for block in blocks:
+      if len(block) < blockSize:
+        raise FilesystemError("Invalid block.")
+    return blocks
+
+
+
+  def _readBlockRun(self, bid, count, origin = "data"):
+    """Reads the specified number of consecutive blocks starting at the given block id with a single
+    read and returns them as one string of bytes."""
+    runSize = count * self._superblock.blockSize
+    self._ioStats.origin = origin
+    run = self._cache.readMany([(bid * self._superblock.blockSize, runSize)])[0]
+    if len(run) < runSize:
+      raise FilesystemError("Invalid block.")
+    return run
+
+
+
   def _freeBlock(self, bid):
     """Frees the block specified by the given block id."""
-    groupNum = (bid - self._superblock.firstDataBlockId) / self._superblock.numBlocksPerGroup
-    indexInGroup = (bid - self._superblock.firstDataBlockId) % self._superblock.numBlocksPerGroup
-    byteIndex = indexInGroup / 8
-    bitIndex = indexInGroup % 8
+    self._freeBlocks([bid])
+
 
-    bgdtEntry = self._bgdt.entries[groupNum]
-    bitmapStartPos = bgdtEntry.blockBitmapLocation * self._superblock.blockSize
-    byte = unpack("B", self._device.read(bitmapStartPos + byteIndex, 1))[0]
-    self._device.write(bitmapStartPos + byteIndex, pack("B", int(byte) & ~(1 << bitIndex)))
-    self._superblock.numFreeBlocks += 1
-    bgdtEntry.numFreeBlocks += 1
 
+  def _freeBlocks(self, bids):
+    """Frees the blocks specified by the given block ids, which must all be in use. The ids are
+    sorted and coalesced into runs of contiguous blocks; each group's bitmap is updated once for all
+    of its runs and each group's counter once, and each run is discarded with a single discard."""
+    firstBlockId = self._superblock.firstDataBlockId
+    blocksPerGroup = self._superblock.numBlocksPerGroup
+    runs = []
+    for bid in sorted(bids):
+      if len(runs) > 0 and runs[-1][0] + runs[-1][1] == bid and (bid - firstBlockId) % blocksPerGroup != 0:
+        runs[-1][1] += 1
+      else:
+        runs.append([bid, 1])
+    groupRuns = {}
+    for start, length in runs:
+      groupRuns.setdefault((start - firstBlockId) / blocksPerGroup, []).append((start, length))
+    
+    extents = self._getFreeExtents()
+    for groupNum in sorted(groupRuns):
+      runs = groupRuns[groupNum]
+      groupStart = groupNum * blocksPerGroup + firstBlockId
+      self._getBlockBitmap(groupNum).clearRanges([(start - groupStart, length) for start, length in runs])
+      numFreed = 0
+      for start, length in runs:
+        extents.free(start, length)
+        numFreed += length
+        if self._discard:
+          self._ioStats.origin = "data"
+          self._cache.discard(start * self._superblock.blockSize, length * self._superblock.blockSize)
+      self._bgdt.entries[groupNum].numFreeBlocks += numFreed
+      self._superblock.numFreeBlocks += numFreed
 
 
-  def _allocateBlock(self, zeros = False):
-    """Allocates the first free block and returns its id."""
-    bitmapSize = self._superblock.numBlocksPerGroup / 8
-    bitmapStartPos = None
-    bgdtEntry = None
-    groupNum = 0
-    
-    for groupNum, bgdtEntry in enumerate(self._bgdt.entries):
-      if bgdtEntry.numFreeBlocks > 0:
-        bitmapStartPos = bgdtEntry.blockBitmapLocation * self._superblock.blockSize
-        break
-    if bitmapStartPos is None:
-      raise FilesystemError("No free blocks.")
 
-    bitmapBytes = self._device.read(bitmapStartPos, bitmapSize)
-    if len(bitmapBytes) < bitmapSize:
-      raise FilesystemError("Invalid block bitmap.")
-    bitmap = unpack("<{0}B".format(bitmapSize), bitmapBytes)
-
-    for byteIndex, byte in enumerate(bitmap):
-      if byte != 255:
-        for i in range(8):
-          if (1 << i) & byte == 0:
-            bid = (groupNum * self._superblock.numBlocksPerGroup) + (byteIndex * 8) + i + self._superblock.firstDataBlockId
-            self._device.write(bitmapStartPos + byteIndex, pack("B", byte | (1 << i)))
-            self._superblock.numFreeBlocks -= 1
-            bgdtEntry.numFreeBlocks -= 1
-            if zeros:
-              start = bid * self._superblock.blockSize
-              zeros = [0] * self._superblock.blockSize
-              fmt = ["B"] * self._superblock.blockSize
-              self._device.write(start, "".join(map(pack, fmt, zeros)))
-            self._superblock.timeLastWrite = int(time())
-            return bid
-    
-    raise FilesystemError("No free blocks.")
-  
-  
-  
-  def _writeToBlock(self, bid, offset, byteString):
-    """Writes the specified byte string to the specified block id at the given offset within the block."""
+  def _allocateBlock(self, zeros = False, goal = None):
+    """Allocates a free block and returns its id. The first free block at or after the goal block
+    id is chosen, wrapping around to the start of the filesystem; without a goal, the first free
+    block of the filesystem is chosen."""
+    return self._allocateBlocks(1, goal, zeros)[0][0]
+  
+  
+  
+  def _allocateBlocks(self, count, goal = None, zeros = False):
+    """Allocates count blocks in as few contiguous runs as possible, searching from the goal block
+    id if one is given, and returns them as a list of (start, length) extents."""
+    if count > self._superblock.numFreeBlocks:
+      raise FilesystemError("No free blocks.")
+    
+    extents = self._getFreeExtents()
+    if count > extents.numFreeBlocks:
+      self._releasePreallocations()
+    allocated = []
+    while count > 0:
+      length = count
+      start = extents.find(length, goal)
+      if start is None:
+        length = min(count, extents.largestFreeExtent)
+        if length == 0:
+          raise FilesystemError("No free blocks.")
+        start = extents.find(length, goal)
+      self.__claimExtent(start, length, zeros)
+      allocated.append((start, length))
+      count -= length
+      goal = start + length
+    return allocated
+  
+  
+  
+  def __claimExtent(self, start, length, zeros):
+    """Removes the specified run of free blocks, which must lie within one block group, from the
+    free extent index and marks it as used. If zeros is True, the blocks are filled with zeros."""
+    self._getFreeExtents().allocate(start, length)
+    self.__useExtent(start, length, zeros)
+  
+  
+  
+  def __useExtent(self, start, length, zeros):
+    """Marks the specified run of blocks, which must lie within one block group and must already
+    be out of the free extent index, as used in the bitmap and updates the counters once. If zeros
+    is True, the blocks are filled with zeros."""
+    groupNum = (start - self._superblock.firstDataBlockId) / self._superblock.numBlocksPerGroup
+    indexInGroup = (start - self._superblock.firstDataBlockId) % self._superblock.numBlocksPerGroup
+    self._getBlockBitmap(groupNum).setRange(indexInGroup, length)
+    self._superblock.numFreeBlocks -= length
+    self._bgdt.entries[groupNum].numFreeBlocks -= length
+    if zeros:
+      self._zeroBlocks(start, length)
+  
+  
+  
+  def _zeroBlocks(self, start, length, origin = "data"):
+    """Fills the specified run of blocks with zeros. The origin names the kind of structure being
+    zeroed, for the I/O statistics."""
+    self._ioStats.origin = origin
+    self._cache.zero(start * self._superblock.blockSize, length * self._superblock.blockSize)
+  
+  
+  
+  def _allocateBlockFor(self, inode, zeros = False):
+    """Allocates a block for the specified inode and returns its id."""
+    return self._allocateBlocksFor(inode, 1, zeros)[0][0]
+  
+  
+  
+  def _allocateBlocksFor(self, inode, count, zeros = False):
+    """Allocates count blocks for the specified inode, first from its preallocation window, and
+    returns them as a list of (start, length) extents."""
+    allocated = []
+    goal = inode.goalBlockId
+    window = self._preallocations.get(inode.number)
+    if window and window[0] != goal:
+      self._releasePreallocation(inode.number)
+      window = None
+    
+    if window:
+      start, length = window
+      taken = min(count, length)
+      if taken < length:
+        self._preallocations[inode.number] = (start + taken, length - taken)
+      else:
+        del self._preallocations[inode.number]
+      self.__useExtent(start, taken, zeros)
+      allocated.append((start, taken))
+      count -= taken
+      goal = start + taken
+    
+    if count > 0:
+      allocated.extend(self._allocateBlocks(count, goal, zeros))
+      start, length = allocated[-1]
+      self.__preallocate(inode, start + length)
+    return allocated
+  
+  
+  
+  def __preallocate(self, inode, bid):
+    """Reserves a preallocation window for the specified inode in the free blocks starting at the
+    specified block id, if there are any, by removing them from the free extent index."""
+    if (inode.mode & 0x4000) != 0:
+      windowSize = self._superblock.numPreallocateBlocksDir
+    else:
+      windowSize = self._superblock.numPreallocateBlocksFile or Ext2Filesystem.DEFAULT_PREALLOCATE_BLOCKS
+    if windowSize == 0 or bid >= self._superblock.numBlocks:
+      return
+    extent = self._getFreeExtents().extentAt(bid)
+    if extent is None:
+      return
+    length = min(windowSize, extent[0] + extent[1] - bid)
+    self._getFreeExtents().allocate(bid, length)
+    self._preallocations[inode.number] = (bid, length)
+  
+  
+  
+  def _releasePreallocation(self, inodeNum):
+    """Returns the unused blocks of the specified inode's preallocation window, if it has one, to
+    the free extent index."""
+    window = self._preallocations.pop(inodeNum, None)
+    if window:
+      self._getFreeExtents().free(window[0], window[1])
+  
+  
+  
+  def _flushDelayedFiles(self):
+    """Writes the data that every file in delayed allocation mode is holding."""
+    for regularFile in self._delayedFiles.values():
+      regularFile.flush()
+  
+  
+  
+  def _releasePreallocations(self):
+    """Returns the unused blocks of every preallocation window to the free extent index."""
+    for inodeNum in self._preallocations.keys():
+      self._releasePreallocation(inodeNum)
+  
+  
+  
+  def _getFreeExtents(self):
+    """Returns the index of free block extents, building it from the block bitmaps with a single
+    pass the first time it is needed after mounting."""
+    if self._freeExtents is None:
+      self.__loadBitmaps(self._blockBitmaps, range(self._superblock.numBlockGroups), False)
+      bitmaps = [self._blockBitmaps[groupNum].bytes for groupNum in range(self._superblock.numBlockGroups)]
+      self._freeExtents = _FreeExtentIndex(self._superblock, bitmaps)
+    return self._freeExtents
+  
+  
+  
+  def _getBlockBitmap(self, groupNum):
+    """Returns the cached block bitmap of the specified block group, reading it if necessary."""
+    bitmap = self._blockBitmaps.get(groupNum)
+    if bitmap is None:
+      self.__loadBitmaps(self._blockBitmaps, [groupNum], False)
+      bitmap = self._blockBitmaps[groupNum]
+    return bitmap
+  
+  
+  
+  def _getInodeBitmap(self, groupNum):
+    """Returns the cached inode bitmap of the specified block group, reading it if necessary."""
+    bitmap = self._inodeBitmaps.get(groupNum)
+    if bitmap is None:
+      self.__loadBitmaps(self._inodeBitmaps, [groupNum], True)
+      bitmap = self._inodeBitmaps[groupNum]
+    return bitmap
+  
+  
+  
+  def __loadBitmaps(self, bitmaps, groupNums, inodes):
+    """Reads the block or inode bitmaps of the specified block groups that are not yet cached into
+    the specified dictionary, with a single batched read."""
+    groupNums = [groupNum for groupNum in groupNums if not groupNum in bitmaps]
+    if inodes:
+      bids = [self._bgdt.entries[groupNum].inodeBitmapLocation for groupNum in groupNums]
+    else:
+      bids = [self._bgdt.entries[groupNum].blockBitmapLocation for groupNum in groupNums]
+    for groupNum, bid, bitmapBytes in zip(groupNums, bids, self._readBlocks(bids, "bitmap")):
+      if inodes:
+        numBits = self._superblock.numInodesPerGroup
+      else:
+        groupStart = groupNum * self._superblock.numBlocksPerGroup + self._superblock.firstDataBlockId
+        numBits = min(self._superblock.numBlocksPerGroup, self._superblock.numBlocks - groupStart)
+      bitmaps[groupNum] = _Bitmap(bitmapBytes, self._bitmapDevice, bid * self._superblock.blockSize, numBits,
+                                  self._durability == "write")
+  
+  
+  
+  def _writeToBlock(self, bid, offset, byteString, origin = "data"):
+    """Writes the specified byte string to the specified block id at the given offset within the block.
+    The origin names the kind of structure being written, for the I/O statistics."""
     assert offset + len(byteString) <= self._superblock.blockSize, "Byte array does not fit within block."
-    self._device.write(offset + bid * self._superblock.blockSize, byteString)
-    self._superblock.timeLastWrite = int(time())
+    self._ioStats.origin = origin
+    self._cache.write(offset + bid * self._superblock.blockSize, byteString)
+    self._isModified = True
     
   
   
   def _readInode(self, inodeNum):
-    """Reads the specified inode number and returns the inode object."""
-    return _Inode.read(inodeNum, self._bgdt, self._superblock, self)
+    """Returns the inode object for the specified inode number, reading it only if it is not cached."""
+    inode = self._inodeCache.get(inodeNum)
+    if inode is None:
+      inode = _Inode.read(inodeNum, self._bgdt, self._superblock, self)
+      self._inodeCache.add(inode)
+    return inode
   
   
   
   def _allocateInode(self, mode, uid, gid, creationTime, modTime, accessTime):
     """Allocates a new inode and returns the inode object."""
-    return _Inode.new(self._bgdt, self._superblock, self, mode, uid, gid, creationTime, modTime, accessTime)
+    inode = _Inode.new(self._bgdt, self._superblock, self, mode, uid, gid, creationTime, modTime, accessTime)
+    self._inodeCache.add(inode)
+    return inode
 
 
 
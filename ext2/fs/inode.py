@@ -6,6 +6,7 @@ __license__ = "BSD"
 __copyright__ = "Copyright 2013, Michael R. Falcone"
 
 
+from array import array
 from struct import pack, unpack, unpack_from
 from time import time
 from math import ceil
@@ -13,7 +14,18 @@ from ..error import FilesystemError
 
 
 class _Inode(object):
-  """Models an inode on the Ext2 fileystem. For internal use only."""
+  """Models an inode on the Ext2 fileystem. Inodes are kept small with __slots__ and hold their
+  block ids in an array. The ids of the data blocks, in file order, are read from the indirect
+  blocks into a second array the first time one is looked up, and kept up to date from then on.
+  Changed fields are collected in a copy of the inode's record, which is written whole by write()
+  and only held while the inode is dirty; dirty inodes are pinned in the filesystem's inode cache.
+  For internal use only."""
+  __slots__ = ("_bgdtEntry", "_tableBid", "_fs", "_superblock", "_inodeTableOffset", "_num", "_used", "_mode",
+               "_uid", "_size", "_timeAccessed", "_timeCreated", "_timeModified", "_timeDeleted", "_gid",
+               "_numLinks", "_numDataBlocks", "_flags", "_blocks", "_numIdsPerBlock", "_numIndirectBlocks",
+               "_numDoublyIndirectBlocks", "_numTreblyIndirectBlocks", "_lastBlockId", "_dirtyBytes",
+               "_blockMap", "_delayedBytes", "_delayedStart", "__weakref__")
+  _numDirectBlocks = 12
 
 
   @property
@@ -21,6 +33,11 @@ class _Inode(object):
     """Gets the inode number of this inode."""
     return self._num
 
+  @property
+  def isDirty(self):
+    """Returns True if the inode has changes that have not been written to the inode table."""
+    return not self._dirtyBytes is None
+
   @property
   def isUsed(self):
     """Returns True if the inode is marked as used, False otherwise."""
@@ -51,6 +68,36 @@ class _Inode(object):
     """Gets the number of blocks used for only data inside the inode."""
     return int(ceil(float(self._size) / self._superblock.blockSize))
 
+  @property
+  def goalBlockId(self):
+    """Gets the preferred block id for the next block allocated to the inode: the block after its
+    last data block, or the first block of the inode's own group if it has no blocks yet."""
+    if self._lastBlockId == 0 and self._numDataBlocks > 0 and self.numDataBlocks > 0:
+      self._lastBlockId = self.lookupBlockId(self.numDataBlocks - 1)
+    if self._lastBlockId != 0:
+      return self._lastBlockId + 1
+    groupNum = (self._num - 1) / self._superblock.numInodesPerGroup
+    return groupNum * self._superblock.numBlocksPerGroup + self._superblock.firstDataBlockId
+
+  @property
+  def delayedBytes(self):
+    """Gets the data held in memory for delayed allocation by the regular files open on this inode,
+    or None if there is none."""
+    return self._delayedBytes
+  @delayedBytes.setter
+  def delayedBytes(self, value):
+    """Sets the data held in memory for delayed allocation, or None once it has been written."""
+    self._delayedBytes = value
+
+  @property
+  def delayedStart(self):
+    """Gets the position in the file of the data held for delayed allocation."""
+    return self._delayedStart
+  @delayedStart.setter
+  def delayedStart(self, value):
+    """Sets the position in the file of the data held for delayed allocation."""
+    self._delayedStart = value
+
   @property
   def mode(self):
     """Gets the mode bitmap."""
@@ -148,36 +195,19 @@ class _Inode(object):
   def new(cls, bgdt, superblock, fs, mode, uid, gid, creationTime, modTime, accessTime):
     """Allocates the first free inode and returns the new inode object."""
     
-    bgroupNum = 0
-    bgdtEntry = None
-    bitmapSize = superblock.numInodesPerGroup / 8
-
-    for bgroupNum, bgdtEntry in enumerate(bgdt.entries):
-      if bgdtEntry.numFreeInodes > 0:
-        break
-    if bgdtEntry is None:
+    bgroupNum = bgdt.freeInodesIndex.findFirst()
+    if bgroupNum is None:
       raise FilesystemError("No free inodes.")
+    bgdtEntry = bgdt.entries[bgroupNum]
 
-    bitmapBytes = fs._readBlock(bgdtEntry.inodeBitmapLocation, 0, bitmapSize)
-    if len(bitmapBytes) < bitmapSize:
-      raise FilesystemError("Invalid inode bitmap.")
-
-    
-    def getAndMarkInode(bitmap):
-      for byteIndex, byte in enumerate(bitmap):
-        if byte != 255:
-          for i in range(8):
-            if (1 << i) & byte == 0:
-              inodeNum = (bgroupNum * superblock.numInodesPerGroup) + (byteIndex * 8) + i + 1
-              if inodeNum < superblock.firstInode:
-                continue
-              fs._writeToBlock(bgdtEntry.inodeBitmapLocation, byteIndex, pack("B", byte | (1 << i)))
-              return inodeNum
-      return None
-
-    inodeNum = getAndMarkInode(unpack("{0}B".format(bitmapSize), bitmapBytes))
-    if inodeNum is None:
+    # reserved inodes are never handed out, even if their bits are clear
+    bitmap = fs._getInodeBitmap(bgroupNum)
+    firstIndex = superblock.firstInode - 1 if bgroupNum == 0 else 0
+    bitIndex = bitmap.findFirstZero(firstIndex)
+    if bitIndex is None:
       raise FilesystemError("No free inodes.")
+    bitmap.set(bitIndex)
+    inodeNum = (bgroupNum * superblock.numInodesPerGroup) + bitIndex + 1
 
     superblock.numFreeInodes -= 1
     bgdtEntry.numFreeInodes -= 1
@@ -199,7 +229,7 @@ class _Inode(object):
     bgroupIndex = (inodeNum - 1) % superblock.numInodesPerGroup
     tableBid = bgdtEntry.inodeTableLocation + (bgroupIndex * superblock.inodeSize) / fs.blockSize
     inodeTableOffset = (bgroupIndex * superblock.inodeSize) % fs.blockSize
-    fs._writeToBlock(tableBid, inodeTableOffset, inodeBytes)
+    fs._writeToBlock(tableBid, inodeTableOffset, inodeBytes, "inodeTable")
 
     return cls(tableBid, inodeTableOffset, inodeBytes, True, inodeNum, bgdtEntry, superblock, fs)
 
@@ -213,16 +243,14 @@ class _Inode(object):
     bgroupIndex = (inodeNum - 1) % superblock.numInodesPerGroup
     bgdtEntry = bgdt.entries[bgroupNum]
 
-    bitmapByteIndex = bgroupIndex / 8
     tableBid = bgdtEntry.inodeTableLocation + (bgroupIndex * superblock.inodeSize) / fs.blockSize
     inodeTableOffset = (bgroupIndex * superblock.inodeSize) % fs.blockSize
     
-    bitmapByte = unpack("B", fs._readBlock(bgdtEntry.inodeBitmapLocation, bitmapByteIndex, 1))[0]
-    inodeBytes = fs._readBlock(tableBid, inodeTableOffset, superblock.inodeSize)
+    isUsed = fs._getInodeBitmap(bgroupNum).isSet(bgroupIndex)
+    inodeBytes = fs._readBlock(tableBid, inodeTableOffset, superblock.inodeSize, "inodeTable")
     if len(inodeBytes) < superblock.inodeSize:
       raise FilesystemError("Invalid inode.")
 
-    isUsed = (bitmapByte & (1 << (bgroupIndex % 8)) != 0)
     return cls(tableBid, inodeTableOffset, inodeBytes, isUsed, inodeNum, bgdtEntry, superblock, fs)
 
 
@@ -260,9 +288,7 @@ class _Inode(object):
     self._numLinks = fields[8]
     self._numDataBlocks = fields[9] / (2 << self._superblock.logBlockSize)
     self._flags = fields[10]
-    self._blocks = []
-    for i in range(15):
-      self._blocks.append(fields[11+i])
+    self._blocks = array("I", fields[11:26])
     if superblock.revisionMajor > 0:
       self._size |= (fields[26] << 32)
     if superblock.creatorOS == "LINUX":
@@ -274,26 +300,28 @@ class _Inode(object):
       self._gid |= (osFields[2] << 16)
 
     self._numIdsPerBlock = self._superblock.blockSize / 4
-    self._numDirectBlocks = 12
     self._numIndirectBlocks = self._numDirectBlocks + self._numIdsPerBlock
     self._numDoublyIndirectBlocks = self._numIndirectBlocks + self._numIdsPerBlock ** 2
     self._numTreblyIndirectBlocks = self._numDoublyIndirectBlocks + self._numIdsPerBlock ** 3
+    self._lastBlockId = 0
+    self._dirtyBytes = None
+    self._blockMap = None
+    self._delayedBytes = None
+    self._delayedStart = 0
 
 
   def free(self):
     """Frees this inode so that it can be reused. All referenced blocks should be freed before calling."""
+    groupNum = (self.number - 1) / self._superblock.numInodesPerGroup
     indexInGroup = (self.number - 1) % self._superblock.numInodesPerGroup
-    byteIndex = indexInGroup / 8
-    bitIndex = indexInGroup % 8
-    
-    byte = unpack("B", self._fs._readBlock(self._bgdtEntry.inodeBitmapLocation, byteIndex, 1))[0]
-    self._fs._writeToBlock(self._bgdtEntry.inodeBitmapLocation, byteIndex, pack("B", int(byte) & ~(1 << bitIndex)))
+    self._fs._getInodeBitmap(groupNum).clear(indexInGroup)
     self._superblock.numFreeInodes += 1
     self._bgdtEntry.numFreeInodes += 1
     if (self.mode & 0x4000) != 0:
       self._bgdtEntry.numInodesAsDirs -= 1
     self.timeDeleted = int(time())
     self._used = False
+    self.write()
     
 
 
@@ -318,10 +346,9 @@ class _Inode(object):
 
     # get doubly indirect blocks
     if self.blocks[13] != 0:
-      for indirectBid in self.__getBidListAtBid(self.blocks[13]):
-        if indirectBid == 0:
-          break
-        for bid in self.__getBidListAtBid(indirectBid):
+      indirectBids = self.__getUsedBids(self.__getBidListAtBid(self.blocks[13]))
+      for indirectBid, bidList in zip(indirectBids, self.__getBidListsAtBids(indirectBids)):
+        for bid in bidList:
           if bid == 0:
             break
           yield bid
@@ -330,13 +357,11 @@ class _Inode(object):
 
     # get trebly indirect blocks
     if self.blocks[14] != 0:
-      for doublyIndirectBid in self.__getBidListAtBid(self.blocks[14]):
-        if doublyIndirectBid == 0:
-          break
-        for indirectBid in self.__getBidListAtBid(doublyIndirectBid):
-          if indirectBid == 0:
-            break
-          for bid in self.__getBidListAtBid(indirectBid):
+      doublyIndirectBids = self.__getUsedBids(self.__getBidListAtBid(self.blocks[14]))
+      for doublyIndirectBid, indirectList in zip(doublyIndirectBids, self.__getBidListsAtBids(doublyIndirectBids)):
+        indirectBids = self.__getUsedBids(indirectList)
+        for indirectBid, bidList in zip(indirectBids, self.__getBidListsAtBids(indirectBids)):
+          for bid in bidList:
             if bid == 0:
               break
             yield bid
@@ -350,35 +375,28 @@ class _Inode(object):
   def lookupBlockId(self, index):
     """Looks up the block id corresponding to the block at the specified index,
     where the block index is the absolute block number within the data."""
-    
-    if index >= self._numDataBlocks:
-      return 0
-    
-    try:
-      if index < self._numDirectBlocks:
-        return self.blocks[index]
-
-      elif index < self._numIndirectBlocks:
-        directList = self.__getBidListAtBid(self.blocks[12])
-        return directList[index - self._numDirectBlocks]
-
-      elif index < self._numDoublyIndirectBlocks:
-        indirectList = self.__getBidListAtBid(self.blocks[13])
-        index -= self._numIndirectBlocks # get index from start of doubly indirect list
-        directList = self.__getBidListAtBid(indirectList[index / self._numIdsPerBlock])
-        return directList[index % self._numIdsPerBlock]
-
-      elif index < self._numTreblyIndirectBlocks:
-        doublyIndirectList = self.__getBidListAtBid(self.blocks[14])
-        index -= self._numDoublyIndirectBlocks # get index from start of trebly indirect list
-        indirectList = self.__getBidListAtBid(doublyIndirectList[index / (self._numIdsPerBlock ** 2)])
-        index %= (self._numIdsPerBlock ** 2) # get index from start of indirect list
-        directList = self.__getBidListAtBid(indirectList[index / self._numIdsPerBlock])
-        return directList[index % self._numIdsPerBlock]
-      
-      return 0
-    except IndexError:
-      return 0
+    if self._blockMap is None:
+      self._blockMap = self.__readBlockMap()
+    if index < len(self._blockMap):
+      return self._blockMap[index]
+    return 0
+  
+  
+  
+  def blockRuns(self):
+    """Returns the inode's data blocks as a list of (logical start, physical start, length) runs of
+    blocks that are contiguous both in the file and on the device, computed in one pass over the
+    block map."""
+    if self._blockMap is None:
+      self._blockMap = self.__readBlockMap()
+    blockMap = self._blockMap
+    runs = []
+    start = 0
+    for i in range(1, len(blockMap) + 1):
+      if i == len(blockMap) or blockMap[i] != blockMap[i-1] + 1:
+        runs.append((start, blockMap[start], i - start))
+        start = i
+    return runs
   
   
   
@@ -386,19 +404,43 @@ class _Inode(object):
     """Assigns the specified string to the block data."""
     pathBytes = pack("<{0}s{1}x".format(len(path), 60 - len(path)), path)
     self.__writeData(40, pathBytes)
-    self._blocks = list(unpack_from("<15I", pathBytes))
+    self._blocks = array("I", unpack_from("<15I", pathBytes))
+    self._blockMap = None
 
 
   def getStringFromBlocks(self):
-    """Reads and returns block data as a string."""
-    pathBytes = self._fs._readBlock(self._tableBid, self._inodeTableOffset + 40, self._size)
+    """Reads and returns block data as a string, from the dirty copy of the record if the inode has
+    changes that have not been written."""
+    if not self._dirtyBytes is None:
+      return str(self._dirtyBytes[40:40+self._size])
+    pathBytes = self._fs._readBlock(self._tableBid, self._inodeTableOffset + 40, self._size, "inodeTable")
     return unpack_from("<{0}s".format(self._size), pathBytes)[0]
 
 
-  def assignNextBlockId(self, bid):
-    """Assigns the given block id to this inode as the next block in use. Returns the new number
-    of blocks."""
+  def numIndirectBlocksAt(self, index):
+    """Returns the number of new indirect blocks needed to map the data block at the specified
+    index when it is assigned as the inode's next block."""
+    idsPerBlock = self._numIdsPerBlock
+    if index < self._numDirectBlocks:
+      return 0
+    index -= self._numDirectBlocks
+    if index < idsPerBlock:
+      return 1 if index == 0 else 0
+    index -= idsPerBlock
+    if index < idsPerBlock ** 2:
+      return (index == 0) + (index % idsPerBlock == 0)
+    index -= idsPerBlock ** 2
+    return (index == 0) + (index % idsPerBlock ** 2 == 0) + (index % idsPerBlock == 0)
+
+
+  def assignNextBlockId(self, bid, indirectBids = None):
+    """Assigns the given block id to this inode as the next block in use. Any new indirect blocks
+    needed to map it are taken in order from the specified list of block ids that have been
+    allocated for them, or are allocated otherwise. Returns the new number of blocks."""
     
+    self._lastBlockId = bid
+    if not self._blockMap is None:
+      self._blockMap.append(bid)
     if self._numDataBlocks < self._numDirectBlocks:
       self._blocks[self._numDataBlocks] = bid
       self.__writeData(40+(self._numDataBlocks*4), pack("<I", bid))
@@ -409,7 +451,7 @@ class _Inode(object):
 
     elif self._numDataBlocks < self._numIndirectBlocks + 1:
       if self.blocks[12] == 0:
-        self.blocks[12] = self._fs._allocateBlock(True)
+        self.blocks[12] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeData(88, pack("<I", self.blocks[12]))
       self.__writeToBidListAtBid(self.blocks[12], self._numDataBlocks - self._numDirectBlocks - 1, bid)
@@ -420,7 +462,7 @@ class _Inode(object):
 
     elif self._numDataBlocks < self._numDoublyIndirectBlocks + self._numIdsPerBlock + 2:
       if self.blocks[13] == 0:
-        self.blocks[13] = self._fs._allocateBlock(True)
+        self.blocks[13] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeData(92, pack("<I", self.blocks[13]))
       indirectList = self.__getBidListAtBid(self.blocks[13])
@@ -430,7 +472,7 @@ class _Inode(object):
       directIndex = index % (self._numIdsPerBlock + 1) - 1
       
       if indirectList[indirectIndex] == 0:
-        indirectList[indirectIndex] = self._fs._allocateBlock(True)
+        indirectList[indirectIndex] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeToBidListAtBid(self.blocks[13], indirectIndex, indirectList[indirectIndex])
         directIndex += 1
@@ -446,7 +488,7 @@ class _Inode(object):
     else:
       index = self._numDataBlocks - self._numDoublyIndirectBlocks - self._numIdsPerBlock - 3
       if self.blocks[14] == 0:
-        self.blocks[14] = self._fs._allocateBlock(True)
+        self.blocks[14] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeData(96, pack("<I", self.blocks[14]))
         index += 1
@@ -458,7 +500,7 @@ class _Inode(object):
       
       
       if doublyIndirectList[doublyIndirectIndex] == 0:
-        doublyIndirectList[doublyIndirectIndex] = self._fs._allocateBlock(True)
+        doublyIndirectList[doublyIndirectIndex] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeToBidListAtBid(self.blocks[14], doublyIndirectIndex, doublyIndirectList[doublyIndirectIndex])
         index += 1
@@ -467,7 +509,7 @@ class _Inode(object):
       indirectIndex = ((index - numDoublyIndirectBlocks - 1) % numDoublyIndirectBlocks) / (self._numIdsPerBlock + 1)
       
       if indirectList[indirectIndex] == 0:
-        indirectList[indirectIndex] = self._fs._allocateBlock(True)
+        indirectList[indirectIndex] = self.__allocateIndirectBlock(indirectBids)
         self._numDataBlocks += 1
         self.__writeToBidListAtBid(doublyIndirectList[doublyIndirectIndex], indirectIndex, indirectList[indirectIndex])
         index += 1
@@ -486,17 +528,83 @@ class _Inode(object):
 
 
 
+  def __allocateIndirectBlock(self, indirectBids):
+    """Returns a zeroed block id for a new indirect block, taking the first of the specified block
+    ids if there are any, or allocating one for the inode otherwise."""
+    if indirectBids:
+      bid = indirectBids.pop(0)
+      self._fs._zeroBlocks(bid, 1, "indirect")
+      return bid
+    return self._fs._allocateBlockFor(self, True)
+
+
+
+
+  def __readBlockMap(self):
+    """Reads the ids of the inode's data blocks in file order from its block lists and returns them
+    as an array, reading each level of indirect blocks with one batched read."""
+    blockMap = array("I")
+    if self._numDataBlocks == 0: # fast symbolic links keep their path in the block list
+      return blockMap
+    
+    blockMap.extend(self.__getUsedBids(list(self._blocks[:12])))
+    if len(blockMap) < 12 or self._blocks[12] == 0:
+      return blockMap
+    blockMap.extend(self.__getUsedBids(self.__getBidListAtBid(self._blocks[12])))
+    
+    if self._blocks[13] != 0:
+      indirectBids = self.__getUsedBids(self.__getBidListAtBid(self._blocks[13]))
+      for bidList in self.__getBidListsAtBids(indirectBids):
+        blockMap.extend(self.__getUsedBids(bidList))
+    
+    if self._blocks[14] != 0:
+      doublyIndirectBids = self.__getUsedBids(self.__getBidListAtBid(self._blocks[14]))
+      indirectBids = []
+      for indirectList in self.__getBidListsAtBids(doublyIndirectBids):
+        indirectBids.extend(self.__getUsedBids(indirectList))
+      for bidList in self.__getBidListsAtBids(indirectBids):
+        blockMap.extend(self.__getUsedBids(bidList))
+    
+    return blockMap
+
+
   def __getBidListAtBid(self, bid):
     """Reads and returns the list of block ids at the specified block id."""
-    return list(unpack_from("<{0}I".format(self._numIdsPerBlock), self._fs._readBlock(bid)))
+    return list(unpack_from("<{0}I".format(self._numIdsPerBlock), self._fs._readBlock(bid, origin = "indirect")))
+
+
+  def __getBidListsAtBids(self, bids):
+    """Reads and returns the lists of block ids at each of the specified block ids."""
+    fmt = "<{0}I".format(self._numIdsPerBlock)
+    return [list(unpack_from(fmt, block)) for block in self._fs._readBlocks(bids, "indirect")]
+
+
+  def __getUsedBids(self, bidList):
+    """Returns the block ids in the specified list up to the first unused (zero) entry."""
+    if 0 in bidList:
+      return bidList[:bidList.index(0)]
+    return bidList
 
 
   def __writeToBidListAtBid(self, listBid, listIndex, bidToWrite):
     """Writes the specified block id to the list at the block id specified by listBid."""
-    self._fs._writeToBlock(listBid, listIndex * 4, pack("<I", bidToWrite))
+    self._fs._writeToBlock(listBid, listIndex * 4, pack("<I", bidToWrite), "indirect")
   
   
+  def write(self):
+    """Writes the whole inode record to the inode table if the inode is dirty."""
+    if self._dirtyBytes is None:
+      return
+    self._fs._writeToBlock(self._tableBid, self._inodeTableOffset, str(self._dirtyBytes), "inodeTable")
+    self._dirtyBytes = None
+    self._fs._inodeCache.unpin(self)
+
+
   def __writeData(self, offset, byteString):
     """Writes the specified string of bytes at the specified offset (from the start of the inode bytes)
-    on the device."""
-    self._fs._writeToBlock(self._tableBid, self._inodeTableOffset + offset, byteString)
+    into the dirty copy of the inode record, making a copy of the record first if the inode is clean."""
+    if self._dirtyBytes is None:
+      self._dirtyBytes = bytearray(self._fs._readBlock(self._tableBid, self._inodeTableOffset,
+                                                       self._superblock.inodeSize, "inodeTable"))
+      self._fs._inodeCache.pin(self)
+    self._dirtyBytes[offset:offset+len(byteString)] = byteString
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Defines the inode cache used by the ext2 module.
+"""
+__license__ = "BSD"
+__copyright__ = "Copyright 2013, Michael R. Falcone"
+
+
+from collections import OrderedDict
+from weakref import WeakValueDictionary
+
+
+class _InodeCache(object):
+  """Maps inode numbers to the single inode object used for each inode while the filesystem is
+  mounted. Every inode object still referenced elsewhere is found through a weak mapping, so two
+  file objects for the same inode always share it. The most recently used inodes are also kept alive
+  up to the maximum number, evicting the least recently used clean inode first. Dirty inodes are
+  pinned until they are written; once more than the maximum number are pinned, the least recently
+  pinned inode is written so that it can be evicted. For internal use only."""
+
+  DEFAULT_SIZE = 1024
+
+
+  @property
+  def maxInodes(self):
+    """Gets the maximum number of unpinned inodes kept alive by the cache."""
+    return self._maxInodes
+
+  @property
+  def numInodes(self):
+    """Gets the number of inodes kept alive by the cache, including pinned inodes."""
+    return len(self._recent) + len(self._pinned)
+
+  @property
+  def numPinnedInodes(self):
+    """Gets the number of pinned inodes."""
+    return len(self._pinned)
+
+  @property
+  def pinnedInodes(self):
+    """Gets a list of the pinned inodes."""
+    return self._pinned.values()
+
+  @property
+  def hits(self):
+    """Gets the number of inode lookups answered from the cache."""
+    return self._hits
+
+  @property
+  def misses(self):
+    """Gets the number of inode lookups that had to read the inode table."""
+    return self._misses
+
+
+  def __init__(self, maxInodes = DEFAULT_SIZE):
+    """Constructs a new empty inode cache."""
+    self._maxInodes = maxInodes
+    self._recent = OrderedDict()
+    self._pinned = OrderedDict()
+    self._live = WeakValueDictionary()
+    self._hits = 0
+    self._misses = 0
+
+
+  def get(self, inodeNum):
+    """Returns the inode object with the specified number, or None if it is not cached."""
+    inode = self._pinned.get(inodeNum)
+    if inode is None:
+      inode = self._recent.pop(inodeNum, None)
+      if inode is None:
+        inode = self._live.get(inodeNum)
+      if inode is None:
+        self._misses += 1
+        return None
+      self.__keep(inode)
+    self._hits += 1
+    return inode
+
+
+  def add(self, inode):
+    """Adds the specified inode object to the cache, replacing any object cached for its number."""
+    self._pinned.pop(inode.number, None)
+    self._recent.pop(inode.number, None)
+    self._live[inode.number] = inode
+    self.__keep(inode)
+
+
+  def pin(self, inode):
+    """Keeps the specified dirty inode object in the cache until it is written and unpinned. If too
+    many inodes are pinned, the least recently pinned ones are written."""
+    self._recent.pop(inode.number, None)
+    self._live[inode.number] = inode
+    self._pinned[inode.number] = inode
+    while len(self._pinned) > self._maxInodes:
+      self._pinned.values()[0].write()
+
+
+  def unpin(self, inode):
+    """Allows the specified inode object to be evicted again once it is least recently used."""
+    if self._pinned.pop(inode.number, None) is inode:
+      self.__keep(inode)
+
+
+  def clear(self):
+    """Drops every inode object from the cache."""
+    self._recent.clear()
+    self._pinned.clear()
+    self._live = WeakValueDictionary()
+
+
+  def __keep(self, inode):
+    """Marks the specified inode object as the most recently used and evicts the least recently used
+    unpinned inodes beyond the maximum number."""
+    self._recent[inode.number] = inode
+    while len(self._recent) > self._maxInodes:
+      self._recent.popitem(last = False)
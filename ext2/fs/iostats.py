@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Defines the classes used to count and time the I/O issued to a device.
+"""
+__license__ = "BSD"
+__copyright__ = "Copyright 2013, Michael R. Falcone"
+
+
+from time import time
+
+
+class _IOStats(object):
+  """Holds counters and latency histograms for the operations issued to a device. Reads, writes,
+  bytes and host system calls are counted separately for each origin (the kind of filesystem
+  structure that caused the access), which is set in the origin attribute before the access is
+  made. For internal use only."""
+
+  ORIGINS = ["superblock", "bgdt", "bitmap", "inodeTable", "directory", "indirect", "data"]
+  LATENCY_BUCKETS = [(0.00001, "<10us"), (0.0001, "<100us"), (0.001, "<1ms"), (0.01, "<10ms"),
+                     (0.1, "<100ms"), (None, ">=100ms")]
+
+
+  def __init__(self):
+    """Constructs a new set of zeroed counters."""
+    self.origin = "data"
+    self.clear()
+
+
+  def clear(self):
+    """Resets all counters and histograms to zero."""
+    self.reads = dict((origin, 0) for origin in self.ORIGINS)
+    self.writes = dict((origin, 0) for origin in self.ORIGINS)
+    self.bytesRead = dict((origin, 0) for origin in self.ORIGINS)
+    self.bytesWritten = dict((origin, 0) for origin in self.ORIGINS)
+    self.syscalls = dict((origin, 0) for origin in self.ORIGINS)
+    self.flushes = 0
+    self.flushSyscalls = 0
+    self.discards = 0
+    self.readLatency = [0] * len(self.LATENCY_BUCKETS)
+    self.writeLatency = [0] * len(self.LATENCY_BUCKETS)
+    self.flushLatency = [0] * len(self.LATENCY_BUCKETS)
+
+
+  def addLatency(self, histogram, seconds):
+    """Adds the specified duration to the specified latency histogram."""
+    for i, (limit, label) in enumerate(self.LATENCY_BUCKETS):
+      if limit is None or seconds < limit:
+        histogram[i] += 1
+        return
+
+
+
+
+class _InstrumentedDevice(object):
+  """Wraps a device, passing every operation through to it and recording the operation in an
+  _IOStats object against the origin currently set on it. Other attributes of the device are
+  available unchanged. For internal use only."""
+
+  @property
+  def isMounted(self):
+    """Returns whether the wrapped device is currently mounted."""
+    return self._device.isMounted
+
+  @property
+  def size(self):
+    """Gets the size of the wrapped device in bytes."""
+    return self._device.size
+
+
+  def __init__(self, device, stats):
+    """Constructs a new wrapper recording the operations on the specified device in stats."""
+    self._device = device
+    self._stats = stats
+
+
+  def __getattr__(self, name):
+    """Returns the named attribute of the wrapped device."""
+    return getattr(self._device, name)
+
+
+  def read(self, position, size):
+    """Reads a byte string of the specified size from the specified position."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    byteString = self._device.read(position, size)
+    self.__recordRead(1, size, start, syscalls)
+    return byteString
+
+
+  def readMany(self, ranges):
+    """Reads the byte strings for a list of (position, size) pairs and returns them in the same order."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    results = self._device.readMany(ranges)
+    self.__recordRead(len(ranges), sum([size for position, size in ranges]), start, syscalls)
+    return results
+
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    self._device.write(position, byteString)
+    self.__recordWrite(1, len(byteString), start, syscalls)
+
+
+  def writeMany(self, writes):
+    """Writes a list of non-overlapping (position, byteString) pairs."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    self._device.writeMany(writes)
+    self.__recordWrite(len(writes), sum([len(byteString) for position, byteString in writes]), start, syscalls)
+
+
+  def zero(self, position, size):
+    """Fills the specified number of bytes at the specified position with zeros."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    self._device.zero(position, size)
+    self.__recordWrite(1, size, start, syscalls)
+
+
+  def discard(self, position, size):
+    """Tells the wrapped device that the specified bytes are no longer in use."""
+    syscalls = self._device.numSyscalls
+    self._device.discard(position, size)
+    self._stats.discards += 1
+    self._stats.syscalls[self._stats.origin] += self._device.numSyscalls - syscalls
+
+
+  def flush(self):
+    """Flushes any buffered writes to the wrapped device."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    self._device.flush()
+    self.__recordFlush(start, syscalls)
+
+
+  def sync(self):
+    """Flushes any buffered writes to the wrapped device at a sync point. Recorded as a flush."""
+    syscalls = self._device.numSyscalls
+    start = time()
+    self._device.sync()
+    self.__recordFlush(start, syscalls)
+
+
+  def __recordRead(self, count, numBytes, start, syscalls):
+    """Records a read of count ranges totalling numBytes against the current origin."""
+    stats = self._stats
+    stats.addLatency(stats.readLatency, time() - start)
+    stats.reads[stats.origin] += count
+    stats.bytesRead[stats.origin] += numBytes
+    stats.syscalls[stats.origin] += self._device.numSyscalls - syscalls
+
+
+  def __recordWrite(self, count, numBytes, start, syscalls):
+    """Records a write of count ranges totalling numBytes against the current origin."""
+    stats = self._stats
+    stats.addLatency(stats.writeLatency, time() - start)
+    stats.writes[stats.origin] += count
+    stats.bytesWritten[stats.origin] += numBytes
+    stats.syscalls[stats.origin] += self._device.numSyscalls - syscalls
+
+
+  def __recordFlush(self, start, syscalls):
+    """Records a flush of the wrapped device."""
+    stats = self._stats
+    stats.addLatency(stats.flushLatency, time() - start)
+    stats.flushes += 1
+    stats.flushSyscalls += self._device.numSyscalls - syscalls
+
+
+
+
+class _TaggedDevice(object):
+  """Passes reads and writes through to a device or block cache after setting the origin of an
+  _IOStats object, so that structures which access the device directly (the superblock and block
+  group descriptor table) are recorded under their own origin. For internal use only."""
+
+  @property
+  def size(self):
+    """Gets the size of the underlying device in bytes."""
+    return self._device.size
+
+
+  def __init__(self, device, stats, origin):
+    """Constructs a new tagged view of the specified device for the specified origin."""
+    self._device = device
+    self._stats = stats
+    self._origin = origin
+
+
+  def read(self, position, size):
+    """Reads a byte string of the specified size from the specified position."""
+    self._stats.origin = self._origin
+    return self._device.read(position, size)
+
+
+  def readMany(self, ranges):
+    """Reads the byte strings for a list of (position, size) pairs and returns them in the same order."""
+    self._stats.origin = self._origin
+    return self._device.readMany(ranges)
+
+
+  def write(self, position, byteString):
+    """Writes the specified byte string to the specified byte position."""
+    self._stats.origin = self._origin
+    self._device.write(position, byteString)
+
+
+  def writeMany(self, writes):
+    """Writes a list of non-overlapping (position, byteString) pairs."""
+    self._stats.origin = self._origin
+    self._device.writeMany(writes)
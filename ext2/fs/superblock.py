@@ -6,14 +6,15 @@ __license__ = "BSD"
 __copyright__ = "Copyright 2013, Michael R. Falcone"
 
 
-from struct import pack,unpack_from
+from struct import pack,pack_into,unpack_from
 from math import ceil
 from ..error import FilesystemError
 
 
 class _Superblock(object):
-  """Provides access to the filesystem's superblock. For internal use only."""
-  _saveCopies = False
+  """Provides access to the filesystem's superblock. Changes to its fields are held in memory
+  until flush() is called, and the shadow copies are only rewritten by writeCopies(). For internal
+  use only."""
 
 
   @property
@@ -221,6 +222,11 @@ class _Superblock(object):
     """Gets the id of the first meta block group."""
     return self._firstMetaGroupId
 
+  @property
+  def isDirty(self):
+    """Gets whether any field has changed since the superblock was read or last flushed."""
+    return self._isDirty
+
   @property
   def logBlockSize(self):
     """Gets the log block size used by the filesystem."""
@@ -418,6 +424,8 @@ class _Superblock(object):
     """Constructs a new superblock from the given byte array."""
     self._byteOffset = byteOffset
     self._device = device
+    self._sbBytes = bytearray(sbBytes[:1024])
+    self._isDirty = False
 
     # read standard fields
     fields = unpack_from("<7Ii5I6H4I2H", sbBytes)
@@ -544,12 +552,34 @@ class _Superblock(object):
 
 
 
+  def flush(self):
+    """Writes the whole superblock to the device with a single write if any field has changed since
+    it was read or last flushed."""
+    if not self._isDirty:
+      return
+    self._device.write(self._byteOffset, str(self._sbBytes))
+    self._isDirty = False
+
+
+
+  def writeCopies(self):
+    """Rewrites every shadow copy of the superblock from this superblock's current fields, each
+    with its own block group number."""
+    writes = []
+    for groupId in self.copyLocations:
+      if groupId == 0:
+        continue
+      copyBytes = bytearray(self._sbBytes)
+      if self._revLevel > 0:
+        pack_into("<H", copyBytes, 90, groupId)
+      sbStart = (groupId * self.numBlocksPerGroup + self.firstDataBlockId) * self.blockSize
+      writes.append((sbStart, str(copyBytes)))
+    self._device.writeMany(writes)
+
+
+
   def __writeData(self, offset, byteString):
     """Writes the specified string of bytes at the specified offset (from the start of the superblock bytes)
-    on the device."""
-    for groupId in self.copyLocations:
-      sbStart = 1024 + groupId * self.numBlocksPerGroup * self.blockSize
-      
-      self._device.write(sbStart + offset, byteString)
-      if not self._saveCopies:
-        break
+    into the in-memory superblock and marks it dirty."""
+    self._sbBytes[offset:offset+len(byteString)] = byteString
+    self._isDirty = True